@@ -0,0 +1,258 @@
+from decimal import Decimal
+from typing import Union
+
+from xrpl.asyncio.clients import AsyncJsonRpcClient
+from xrpl.models import XRP, IssuedCurrency, IssuedCurrencyAmount, Ledger
+from xrpl.models.requests import GenericRequest
+from xrpl.utils import drops_to_xrp
+
+from misc import LedgerCache, currency_key, validate_hex_to_symbol, xrp_format_to_amm_fee
+from offers import all_offers, order_book_swap
+
+
+# https://xrpl.org/docs/concepts/tokens/decentralized-exchange/automated-market-makers
+# https://github.com/XRPLF/XRPL-Standards/tree/master/XLS-0030d-automated-market-maker
+
+# pools read with `amm_pool`, keyed by (url, asset, asset2)
+AMM_POOLS = LedgerCache()
+
+
+# region GET
+
+
+def parse_amm_amount(amount: Union[str, dict]) -> dict:
+    """parse an amm_info amount, xrp is returned in xrp not drops"""
+    if isinstance(amount, str):
+        return {"token": "XRP", "currency": "XRP", "issuer": "", "amount": str(drops_to_xrp(amount))}
+    return {
+        "token": validate_hex_to_symbol(amount["currency"]),
+        "currency": amount["currency"],
+        "issuer": amount["issuer"],
+        "amount": amount["value"],
+    }
+
+
+async def amm_info(url: str, asset: Union[XRP, IssuedCurrency], asset2: Union[XRP, IssuedCurrency], ledger_index: Union[int, str] = "validated") -> dict:
+    """returns the state of an amm pool: balances, trading fee and lp token supply"""
+    pool = {}
+    # the xrpl-py AMMInfo model has no ledger_index, so the request is built by hand
+    req = GenericRequest(method="amm_info", asset=asset.to_dict(), asset2=asset2.to_dict(), ledger_index=ledger_index)
+    response = await AsyncJsonRpcClient(url).request(req)
+    result = response.result
+    if "amm" in result:
+        amm = result["amm"]
+        pool["amm_account"] = amm["account"]
+        pool["asset"] = parse_amm_amount(amm["amount"])
+        pool["asset2"] = parse_amm_amount(amm["amount2"])
+        pool["lp_token"] = parse_amm_amount(amm["lp_token"])
+        pool["trading_fee"] = xrp_format_to_amm_fee(amm["trading_fee"])
+        pool["ledger_index"] = result["ledger_index"] if "ledger_index" in result else result["ledger_current_index"]
+    return pool
+
+
+async def amm_pool(url: str, asset: Union[XRP, IssuedCurrency], asset2: Union[XRP, IssuedCurrency], ledger_index: int = None, max_age: float = 10) -> dict:
+    """returns an amm pool from the cache, reading it from the ledger only when needed\n
+    without `ledger_index` a pool cached less than `max_age` seconds ago is returned, with it the pool is read at that ledger once and then served from the cache"""
+    key = (url, currency_key(asset), currency_key(asset2))
+    pool = AMM_POOLS.get(key, ledger_index, max_age if ledger_index is None else None)
+    if pool is None:
+        pool = await amm_info(url, asset, asset2, "validated" if ledger_index is None else ledger_index)
+        if pool:
+            AMM_POOLS.set(key, pool["ledger_index"], pool)
+    return pool
+
+
+# endregion
+
+
+# region QUOTE
+"""local quotes from pool state, no network calls. amounts are in xrp/token units, results are strings"""
+
+
+def amount_str(value: Decimal) -> str:
+    """format a quote amount without exponent notation"""
+    return format(value.normalize(), "f") if value else "0"
+
+
+def pool_sides(pool: dict, asset: Union[XRP, IssuedCurrency]) -> tuple:
+    """return (side of `asset`, other side) of a pool"""
+    key = currency_key(asset)
+    if (pool["asset"]["currency"], pool["asset"]["issuer"]) == key:
+        return pool["asset"], pool["asset2"]
+    if (pool["asset2"]["currency"], pool["asset2"]["issuer"]) == key:
+        return pool["asset2"], pool["asset"]
+    raise ValueError(f"{key[0]} is not an asset of amm {pool['amm_account']}")
+
+
+def amm_fee(pool: dict) -> Decimal:
+    """trading fee as a fraction"""
+    return Decimal(str(pool["trading_fee"])) / 100
+
+
+def amm_swap_quote(pool: dict, asset_in: Union[XRP, IssuedCurrency], amount_in: Union[str, float, Decimal]) -> dict:
+    """quote swapping `amount_in` of `asset_in` into the pool for the other asset\n
+    price impact is the move of the pool price caused by the trade, the trading fee is reported separately"""
+    side_in, side_out = pool_sides(pool, asset_in)
+    reserve_in = Decimal(side_in["amount"])
+    reserve_out = Decimal(side_out["amount"])
+    amount_in = Decimal(str(amount_in))
+    fee = amm_fee(pool)
+    amount_in_after_fee = amount_in * (1 - fee)
+    amount_out = reserve_out * amount_in_after_fee / (reserve_in + amount_in_after_fee)
+    spot_price = reserve_out / reserve_in
+    return {
+        "token_in": side_in["token"],
+        "token_out": side_out["token"],
+        "amount_in": amount_str(amount_in),
+        "amount_out": amount_str(amount_out),
+        "fee_paid": amount_str(amount_in * fee),
+        "spot_price": amount_str(spot_price),
+        "effective_price": amount_str(amount_out / amount_in) if amount_in else amount_str(spot_price),
+        "price_impact": amount_str(amount_in_after_fee / (reserve_in + amount_in_after_fee) * 100),
+    }
+
+
+def amm_swap_in_quote(pool: dict, asset_out: Union[XRP, IssuedCurrency], amount_out: Union[str, float, Decimal]) -> dict:
+    """quote how much of the other asset must be swapped in to get `amount_out` of `asset_out`"""
+    side_out, side_in = pool_sides(pool, asset_out)
+    reserve_in = Decimal(side_in["amount"])
+    reserve_out = Decimal(side_out["amount"])
+    amount_out = Decimal(str(amount_out))
+    if amount_out >= reserve_out:
+        raise ValueError(f"amm {pool['amm_account']} holds only {reserve_out} {side_out['token']}")
+    amount_in = reserve_in * amount_out / ((reserve_out - amount_out) * (1 - amm_fee(pool)))
+    return amm_swap_quote(pool, XRP() if side_in["currency"] == "XRP" else IssuedCurrency(currency=side_in["currency"], issuer=side_in["issuer"]), amount_in)
+
+
+def amm_deposit_quote(pool: dict, asset: Union[XRP, IssuedCurrency], amount: Union[str, float, Decimal], amount2: Union[str, float, Decimal] = None) -> dict:
+    """quote the lp tokens received for a deposit\n
+    with only `amount` it is a single asset deposit of `asset`, which pays the trading fee on the half that is swapped\n
+    with `amount2` (of the other asset) it is a two asset deposit at the pool ratio; the unused part of either amount is returned"""
+    side, other = pool_sides(pool, asset)
+    reserve = Decimal(side["amount"])
+    reserve2 = Decimal(other["amount"])
+    lp_supply = Decimal(pool["lp_token"]["amount"])
+    amount = Decimal(str(amount))
+    if amount2 is None:
+        lp_tokens = lp_supply * ((1 + amount * (1 - amm_fee(pool) / 2) / reserve).sqrt() - 1)
+        deposit, deposit2 = amount, Decimal(0)
+    else:
+        ratio = min(amount / reserve, Decimal(str(amount2)) / reserve2)
+        lp_tokens = lp_supply * ratio
+        deposit, deposit2 = reserve * ratio, reserve2 * ratio
+    return {
+        "lp_tokens": amount_str(lp_tokens),
+        "pool_share": amount_str(lp_tokens / (lp_supply + lp_tokens) * 100),
+        "token": side["token"],
+        "amount": amount_str(deposit),
+        "token2": other["token"],
+        "amount2": amount_str(deposit2),
+    }
+
+
+def amm_withdraw_quote(pool: dict, lp_tokens: Union[str, float, Decimal], asset: Union[XRP, IssuedCurrency] = None) -> dict:
+    """quote the assets received for redeeming `lp_tokens`\n
+    without `asset` both assets are withdrawn at the pool ratio, with it only `asset` is withdrawn and the trading fee applies"""
+    lp_supply = Decimal(pool["lp_token"]["amount"])
+    share = Decimal(str(lp_tokens)) / lp_supply
+    if share > 1:
+        raise ValueError(f"amm {pool['amm_account']} has only {lp_supply} lp tokens")
+    if asset is None:
+        return {
+            "token": pool["asset"]["token"],
+            "amount": amount_str(Decimal(pool["asset"]["amount"]) * share),
+            "token2": pool["asset2"]["token"],
+            "amount2": amount_str(Decimal(pool["asset2"]["amount"]) * share),
+        }
+    side, other = pool_sides(pool, asset)
+    amount = Decimal(side["amount"]) * (1 - (1 - share) ** 2) * (1 - amm_fee(pool) / 2)
+    return {"token": side["token"], "amount": amount_str(amount), "token2": other["token"], "amount2": "0"}
+
+
+# endregion
+
+
+# region ROUTE
+
+
+def swap_amount(asset: Union[XRP, IssuedCurrency], value: Decimal) -> Union[float, IssuedCurrencyAmount]:
+    """amount in the form `order_book_swap` takes, xrp as float and tokens with at most 15 significant digits"""
+    if isinstance(asset, XRP):
+        return float(round(value, 6))
+    return IssuedCurrencyAmount(currency=asset.currency, issuer=asset.issuer, value=amount_str(Decimal(f"{value:.15g}")))
+
+
+def route_swap(pool: dict, offers: list, spend_asset: Union[XRP, IssuedCurrency], receive_asset: Union[XRP, IssuedCurrency], amount: Union[str, float, Decimal], sender_addr: str = None, slippage: float = 0.5, fee: str = None) -> dict:
+    """split spending `amount` of `spend_asset` between the order book and the amm for the most `receive_asset`\n
+    `offers` is the book from `all_offers(url, pay=receive_asset, receive=spend_asset)`, `pool` is from `amm_pool` (or {} for book only)\n
+    each offer is taken while it beats the amm's marginal price, the amm fills the gaps between offers and whatever is left\n
+    with `sender_addr` a swap transaction is built whose minimum output is the expected fill less `slippage` percent;
+    one immediate-or-cancel OfferCreate is enough since rippled crosses the book and the amm in the same quality order"""
+    remaining = Decimal(str(amount))
+    fills = []
+    amm_in = Decimal(0)
+    if pool:
+        side_in, side_out = pool_sides(pool, spend_asset)
+        reserve_in = Decimal(side_in["amount"])
+        reserve_out = Decimal(side_out["amount"])
+        fee_keep = 1 - amm_fee(pool)
+
+    def amm_in_at_rate(rate: Decimal) -> Decimal:
+        # amount in at which the amm's marginal rate d(out)/d(in) falls to `rate`
+        if not pool:
+            return Decimal(0)
+        return max((fee_keep * reserve_in * reserve_out / rate).sqrt() - reserve_in, Decimal(0)) / fee_keep
+
+    book = sorted(offers, key=lambda of: Decimal(of["sell_amount"]) / Decimal(of["buy_amount"]), reverse=True)
+    for offer in book:
+        if remaining <= 0:
+            break
+        rate = Decimal(offer["sell_amount"]) / Decimal(offer["buy_amount"])
+        take = min(max(amm_in_at_rate(rate) - amm_in, Decimal(0)), remaining)
+        amm_in += take
+        remaining -= take
+        fill = min(Decimal(offer["buy_amount"]), remaining)
+        if fill > 0:
+            fills.append({"offer_id": offer["offer_id"], "amount_in": amount_str(fill), "amount_out": amount_str(fill * rate), "rate": amount_str(rate)})
+            remaining -= fill
+    if pool and remaining > 0:
+        amm_in += remaining
+        remaining = Decimal(0)
+
+    book_in = sum((Decimal(f["amount_in"]) for f in fills), Decimal(0))
+    book_out = sum((Decimal(f["amount_out"]) for f in fills), Decimal(0))
+    amm_out = Decimal(amm_swap_quote(pool, spend_asset, amm_in)["amount_out"]) if amm_in else Decimal(0)
+    total_in = book_in + amm_in
+    total_out = book_out + amm_out
+    route = {
+        "amount_in": amount_str(total_in),
+        "amount_out": amount_str(total_out),
+        "unfilled": amount_str(remaining),
+        "average_rate": amount_str(total_out / total_in) if total_in else "0",
+        "book_in": amount_str(book_in),
+        "book_out": amount_str(book_out),
+        "amm_in": amount_str(amm_in),
+        "amm_out": amount_str(amm_out),
+        "fills": fills,
+        "transactions": [],
+    }
+    if sender_addr is not None and total_out > 0:
+        min_out = total_out * (1 - Decimal(str(slippage)) / 100)
+        route["transactions"].append(
+            order_book_swap(sender_addr, buy=swap_amount(receive_asset, min_out), sell=swap_amount(spend_asset, total_in), tf_sell=True, tf_immediate_or_cancel=True, fee=fee)
+        )
+    return route
+
+
+async def best_swap(url: str, sender_addr: str, spend_asset: Union[XRP, IssuedCurrency], receive_asset: Union[XRP, IssuedCurrency], amount: Union[str, float, Decimal], ledger_index: int = None, slippage: float = 0.5, fee: str = None) -> dict:
+    """route a swap with the amm pool and the book read at the same ledger, see `route_swap`\n
+    without `ledger_index` the latest validated ledger is used"""
+    if ledger_index is None:
+        response = await AsyncJsonRpcClient(url).request(Ledger(ledger_index="validated"))
+        ledger_index = response.result["ledger_index"]
+    pool = await amm_pool(url, spend_asset, receive_asset, ledger_index)
+    offers = await all_offers(url, pay=receive_asset, receive=spend_asset, ledger_index=ledger_index)
+    return route_swap(pool, offers, spend_asset, receive_asset, amount, sender_addr, slippage, fee)
+
+
+# endregion
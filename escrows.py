@@ -1,5 +1,8 @@
+import asyncio
+import heapq
+import time
 from decimal import Decimal
-from typing import Union
+from typing import Awaitable, Callable, Union
 from xrpl.models import (
     LedgerEntry,
     IssuedCurrencyAmount,
@@ -15,14 +18,21 @@ from xrpl.utils import (
     ripple_time_to_datetime,
     xrp_to_drops,
     datetime_to_ripple_time,
+    posix_to_ripple_time,
 )
 
-from misc import validate_hex_to_symbol, validate_symbol_to_hex, mm
+from misc import LedgerCache, gather_limited, validate_hex_to_symbol, validate_symbol_to_hex, mm
 from x_constants import M_SOURCE_TAG
 
 
 #  https://xrpl.org/docs/concepts/payment-types/escrow
 
+# sequence of the EscrowCreate behind an escrow, keyed by its PreviousTxnID; escrows are never modified so it never goes stale
+ESCROW_SEQUENCES = LedgerCache()
+
+# seconds to wait past FinishAfter/CancelAfter, a ledger's close time has to be after them and is rounded to 10 seconds
+ESCROW_DUE_MARGIN = 10
+
 
 # region POST
 def create_xrp_escrow(
@@ -101,12 +111,19 @@ def cancel_escrow(
 # region GET
 async def escrow_sequence(url: str, prev_txn_id: str) -> int:
     """return escrow sequence for completing  or cancelling escrow"""
+    seq = ESCROW_SEQUENCES.get(prev_txn_id)
+    if seq is not None:
+        return seq
     seq = 0
     req = Tx(transaction=prev_txn_id)
     response = await AsyncJsonRpcClient(url).request(req)
     result = response.result
-    if "Sequence" in result:
-        seq = result["Sequence"]
+    # api v2 nests the transaction under tx_json
+    tx = result["tx_json"] if "tx_json" in result else result
+    if "Sequence" in tx:
+        # escrows created with a ticket are referenced by the ticket sequence
+        seq = tx["Sequence"] or tx.get("TicketSequence", 0)
+        ESCROW_SEQUENCES.set(prev_txn_id, None, seq)
     return seq
 
 
@@ -184,31 +201,112 @@ async def xrp_escrow_info(url: str, escrow_id: str) -> dict:
 # endregion
 
 
-
-from xrpl.transaction import sign_and_submit
-from xrpl.wallet import Wallet
-from xrpl.models import Transaction
-from xrpl.clients import JsonRpcClient
-
-acc1_addr = "rpmsgLmYHky4Qw7fGu4jLr4Xu1dS5Q849n"
-acc1 = Wallet.from_seed(
-    seed="sEdTrmLZpWyUeUnFwq7bze2yFUxJByh"
-) 
+# region SCHEDULE
+
+
+class EscrowScheduler:
+    """index escrows by when they can be finished or cancelled and hand out the transactions once they are due\n
+    owner sequences are resolved when an escrow is added, so `due` builds complete_xrp_escrow / cancel_escrow
+    transactions without a request; `run` sleeps until the next escrow matures instead of polling them all.
+    escrows with a condition are only finished once `set_fulfillment` has been given one"""
+
+    def __init__(self, url: str, sender_addr: str, fee: str = None, margin: int = ESCROW_DUE_MARGIN):
+        self.url = url
+        self.sender_addr = sender_addr
+        self.fee = fee
+        self.margin = margin
+        self.escrows = {}  # escrow id: {owner, sequence, finish_after, cancel_after, condition}
+        self.fulfillments = {}
+        self._heap = []  # (ripple time due, action, escrow id)
+
+    def __len__(self) -> int:
+        return len(self.escrows)
+
+    async def add(self, escrow: dict) -> dict:
+        """index an Escrow ledger object, as returned by account_objects or ledger_entry"""
+        sequence = escrow.get("Sequence") or await escrow_sequence(self.url, escrow["PreviousTxnID"])
+        entry = {
+            "owner": escrow["Account"],
+            "sequence": sequence,
+            "finish_after": escrow.get("FinishAfter"),
+            "cancel_after": escrow.get("CancelAfter"),
+            "condition": escrow.get("Condition"),
+        }
+        self.escrows[escrow["index"]] = entry
+        if entry["finish_after"] is not None or escrow["index"] in self.fulfillments:
+            heapq.heappush(self._heap, (entry["finish_after"] or 0, "finish", escrow["index"]))
+        if entry["cancel_after"] is not None:
+            heapq.heappush(self._heap, (entry["cancel_after"], "cancel", escrow["index"]))
+        return entry
+
+    async def load_account(self, wallet_addr: str, limit: int = 10) -> int:
+        """index every escrow an account sent or receives, returns how many"""
+        client = AsyncJsonRpcClient(self.url)
+        escrows = []
+        marker = None
+        while True:
+            req = AccountObjects(account=wallet_addr, ledger_index="validated", type="escrow", limit=400, marker=marker)
+            result = (await client.request(req)).result
+            escrows.extend(result.get("account_objects", []))
+            marker = result.get("marker")
+            if marker is None:
+                break
+        await gather_limited((self.add(escrow) for escrow in escrows), limit)
+        return len(escrows)
+
+    def remove(self, escrow_id: str) -> None:
+        """stop tracking an escrow, e.g once it was finished or cancelled; its heap entries are skipped when popped"""
+        self.escrows.pop(escrow_id, None)
+        self.fulfillments.pop(escrow_id, None)
+
+    def set_fulfillment(self, escrow_id: str, fulfillment: str) -> None:
+        """fulfillment for a conditional escrow, it is finished on the first `due` after its FinishAfter"""
+        self.fulfillments[escrow_id] = fulfillment
+        entry = self.escrows.get(escrow_id)
+        if entry is not None:
+            heapq.heappush(self._heap, (entry["finish_after"] or 0, "finish", escrow_id))
+
+    def next_due(self) -> int:
+        """ripple time at which the next escrow becomes actionable, None if nothing is scheduled"""
+        while self._heap and self._heap[0][2] not in self.escrows:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] + self.margin if self._heap else None
+
+    def due(self, now: int = None) -> list:
+        """pop every escrow that can be finished or cancelled at ripple time `now`\n
+        returns [{escrow_id, action, tx}] with tx a builder dict ready to fill and sign"""
+        now = posix_to_ripple_time(int(time.time())) if now is None else now
+        ready = []
+        while self._heap and self._heap[0][0] + self.margin <= now:
+            _, action, escrow_id = heapq.heappop(self._heap)
+            entry = self.escrows.get(escrow_id)
+            if entry is None:
+                continue
+            if action == "cancel":
+                tx = cancel_escrow(self.sender_addr, entry["owner"], entry["sequence"], fee=self.fee)
+            elif entry["cancel_after"] is not None and entry["cancel_after"] + self.margin <= now:
+                continue  # past its CancelAfter an escrow can only be cancelled
+            elif entry["condition"] is not None and escrow_id not in self.fulfillments:
+                continue  # set_fulfillment schedules it again
+            else:
+                tx = complete_xrp_escrow(
+                    self.sender_addr, entry["owner"], entry["sequence"],
+                    entry["condition"], self.fulfillments.get(escrow_id), fee=self.fee,
+                )
+            self.remove(escrow_id)
+            ready.append({"escrow_id": escrow_id, "action": action, "tx": tx})
+        return ready
+
+    async def run(self, on_due: Callable[[list], Awaitable], idle: int = 60) -> None:
+        """call `on_due` with every batch of due transactions as soon as it matures, runs until cancelled\n
+        wakes at least every `idle` seconds so escrows added meanwhile are picked up"""
+        while True:
+            ready = self.due()
+            if ready:
+                await on_due(ready)
+            next_due = self.next_due()
+            now = posix_to_ripple_time(int(time.time()))
+            await asyncio.sleep(min(max(next_due - now, 0), idle) if next_due is not None else idle)
 
 
-
-x = create_xrp_escrow(
-    acc1.address, 10, "rBoSibkbwaAUEpkehYixQrXp4AqZez9WqA"
-
-)
-
-
-acc1_addr = "rpmsgLmYHky4Qw7fGu4jLr4Xu1dS5Q849n"
-acc1 = Wallet.from_seed(
-    seed="sEdTrmLZpWyUeUnFwq7bze2yFUxJByh"
-) 
-
-
-ccl =JsonRpcClient("https://s.altnet.rippletest.net:51234")
-
-print(sign_and_submit(transaction=Transaction.from_xrpl(x), client=ccl, wallet=acc1 ))
\ No newline at end of file
+# endregion
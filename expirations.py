@@ -0,0 +1,148 @@
+import heapq
+import time
+from typing import Iterable, List
+
+from xrpl.asyncio.clients import AsyncJsonRpcClient, AsyncWebsocketClient
+from xrpl.models import AccountObjects, Subscribe
+from xrpl.utils import posix_to_ripple_time, ripple_time_to_datetime
+
+from checks import cancel_check
+from misc import gather_limited
+from nftoffers import NFT_OFFER_CANCEL_MAX, cancel_nft_offer
+from offers import cancel_offer
+
+
+# time ordered index of checks, offers and nft offers that carry an Expiration,
+# so finding what is about to expire and reclaiming the reserves doesn't take a scan of every account
+# https://xrpl.org/docs/concepts/accounts/reserves#owner-reserves
+
+# ledger entry type: short kind used in records
+EXPIRING_ENTRY_TYPES = {"Check": "check", "Offer": "offer", "NFTokenOffer": "nft_offer"}
+
+
+def parse_expiring_object(entry_type: str, fields: dict, object_id: str) -> dict:
+    """record of an expiring ledger object: id, kind, owner, destination, expiration (ripple time), sequence"""
+    return {
+        "id": object_id,
+        "kind": EXPIRING_ENTRY_TYPES[entry_type],
+        "owner": fields["Owner"] if entry_type == "NFTokenOffer" else fields["Account"],
+        "destination": fields.get("Destination", ""),
+        "expiration": fields["Expiration"],
+        "sequence": fields.get("Sequence"),
+    }
+
+
+class ExpiryIndex:
+    """checks, offers and nft offers ordered by Expiration\n
+    `load_accounts` reads the objects once, after that `watch` keeps the index current from the validated
+    transaction stream; `expiring` answers "what expires in the next n seconds" from memory
+    and `cancel_transactions` turns expired objects into cancel transactions"""
+
+    def __init__(self):
+        self.objects = {}  # object id: record
+        self._heap = []  # (expiration, object id)
+
+    def __len__(self) -> int:
+        return len(self.objects)
+
+    def add(self, record: dict) -> None:
+        known = self.objects.get(record["id"])
+        self.objects[record["id"]] = record
+        if known is None or known["expiration"] != record["expiration"]:
+            heapq.heappush(self._heap, (record["expiration"], record["id"]))
+
+    def remove(self, object_id: str) -> None:
+        """forget an object, its heap entry is dropped lazily"""
+        self.objects.pop(object_id, None)
+
+    def add_ledger_object(self, ledger_object: dict) -> bool:
+        """index an account_objects entry, returns False if it can't expire"""
+        if ledger_object.get("LedgerEntryType") not in EXPIRING_ENTRY_TYPES or "Expiration" not in ledger_object:
+            return False
+        self.add(parse_expiring_object(ledger_object["LedgerEntryType"], ledger_object, ledger_object["index"]))
+        return True
+
+    async def load_account(self, url: str, wallet_addr: str) -> int:
+        """index an account's expiring objects, returns how many"""
+        client = AsyncJsonRpcClient(url)
+        count = 0
+        for object_type in ("check", "offer", "nft_offer"):
+            marker = None
+            while True:
+                req = AccountObjects(account=wallet_addr, ledger_index="validated", type=object_type, limit=400, marker=marker)
+                result = (await client.request(req)).result
+                for ledger_object in result.get("account_objects", []):
+                    # checks show up for both sender and receiver
+                    if ledger_object["index"] not in self.objects:
+                        count += self.add_ledger_object(ledger_object)
+                marker = result.get("marker")
+                if marker is None:
+                    break
+        return count
+
+    async def load_accounts(self, url: str, wallet_addrs: Iterable[str], limit: int = 10) -> int:
+        """index many accounts concurrently, returns how many objects were added"""
+        return sum(await gather_limited((self.load_account(url, addr) for addr in wallet_addrs), limit))
+
+    def apply_transaction(self, message: dict) -> None:
+        """add created and drop deleted objects from a validated transaction stream message"""
+        for node in message.get("meta", {}).get("AffectedNodes", []):
+            kind, entry = next(iter(node.items()))
+            entry_type = entry.get("LedgerEntryType")
+            if entry_type not in EXPIRING_ENTRY_TYPES:
+                continue
+            if kind == "DeletedNode":
+                self.remove(entry["LedgerIndex"])
+            elif kind == "CreatedNode" and "Expiration" in entry.get("NewFields", {}):
+                self.add(parse_expiring_object(entry_type, entry["NewFields"], entry["LedgerIndex"]))
+
+    async def watch(self, ws_url: str, accounts: List[str]) -> None:
+        """apply validated transactions of `accounts`, runs until cancelled"""
+        async with AsyncWebsocketClient(ws_url) as client:
+            await client.request(Subscribe(accounts=accounts))
+            async for message in client:
+                if message.get("type") == "transaction" and message.get("validated"):
+                    self.apply_transaction(message)
+
+    def expiring(self, within: int = 0, now: int = None, kinds: Iterable[str] = None) -> List[dict]:
+        """objects expiring within `within` seconds of `now` (ripple time), already expired ones included, soonest first"""
+        now = posix_to_ripple_time(int(time.time())) if now is None else now
+        kinds = set(kinds) if kinds else None
+        found = []
+        # the heap can't be walked in order without popping, so pop and put back what was looked at
+        popped = []
+        while self._heap and self._heap[0][0] <= now + within:
+            item = heapq.heappop(self._heap)
+            record = self.objects.get(item[1])
+            if record is None or record["expiration"] != item[0]:
+                continue  # removed or re-added since
+            popped.append(item)
+            if kinds is None or record["kind"] in kinds:
+                found.append(dict(record, expiry_date=str(ripple_time_to_datetime(record["expiration"]))))
+        for item in popped:
+            heapq.heappush(self._heap, item)
+        return found
+
+    def expired(self, now: int = None, kinds: Iterable[str] = None) -> List[dict]:
+        # an object whose Expiration equals the last close time has already expired
+        return self.expiring(0, now, kinds)
+
+    def cancel_transactions(self, sender_addr: str, records: List[dict], now: int = None, fee: str = None) -> List[dict]:
+        """build the cancel transactions `sender_addr` is allowed to send for `records`\n
+        anyone may cancel an expired check or nft offer, a dex offer only its owner;
+        nft offers are batched up to NFT_OFFER_CANCEL_MAX per transaction"""
+        now = posix_to_ripple_time(int(time.time())) if now is None else now
+        txs = []
+        nft_offer_ids = []
+        for record in records:
+            expired = record["expiration"] <= now
+            party = sender_addr in (record["owner"], record["destination"])
+            if record["kind"] == "check" and (expired or party):
+                txs.append(cancel_check(sender_addr, record["id"], fee=fee))
+            elif record["kind"] == "offer" and sender_addr == record["owner"]:
+                txs.append(cancel_offer(sender_addr, record["sequence"], fee=fee))
+            elif record["kind"] == "nft_offer" and (expired or party):
+                nft_offer_ids.append(record["id"])
+        for i in range(0, len(nft_offer_ids), NFT_OFFER_CANCEL_MAX):
+            txs.append(cancel_nft_offer(sender_addr, nft_offer_ids[i:i + NFT_OFFER_CANCEL_MAX], fee=fee))
+        return txs
@@ -1,3 +1,7 @@
+import asyncio
+import time
+from typing import Awaitable, Iterable
+
 from xrpl.models import Memo
 from x_constants import D_DATA, D_TYPE
 from xrpl.utils import (
@@ -58,8 +62,12 @@ def memo_builder(
     )
 
 
+# the myrkle memo never changes, so it is hex-encoded once and shared by every transaction
+M_MEMO = memo_builder(memo_type=D_TYPE, memo_data=D_DATA)
+
+
 def mm():
-    return [memo_builder(memo_type=D_TYPE, memo_data=D_DATA)]
+    return [M_MEMO]
 
 
 """
@@ -105,6 +113,12 @@ def xrp_format_to_transfer_fee(format: int) -> float:
     return val / base_fee * 100
 
 
+def xrp_format_to_amm_fee(format: int) -> float:
+    """convert xrp amm trading fee format to usable fee in percentage"""
+    assert format <= 1000
+    return format / 1000
+
+
 def is_hex(hex_string: str) -> bool:
     """check if the string is hex"""
     is_hex = False
@@ -130,3 +144,50 @@ def scale_from_value(value: str) -> int:
     if scale < 0:
         scale = 0
     return scale
+
+
+async def gather_limited(coros: Iterable[Awaitable], limit: int = 10) -> list:
+    """run coroutines concurrently with at most `limit` in flight, results keep input order"""
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coro: Awaitable):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*(run(coro) for coro in coros))
+
+
+def currency_key(currency) -> tuple:
+    """return a hashable (currency, issuer) key for XRP, IssuedCurrency, amounts or their dict forms"""
+    if isinstance(currency, str):  # xrp amount in drops
+        return ("XRP", "")
+    if not isinstance(currency, dict):
+        currency = currency.to_dict()
+    return (currency["currency"], currency.get("issuer", ""))
+
+
+class LedgerCache:
+    """hold one value per key together with the ledger index it was read at"""
+
+    def __init__(self, max_entries: int = 10_000):
+        self.max_entries = max_entries
+        self._entries = {}
+
+    def get(self, key, ledger_index: int = None, max_age: float = None):
+        """return the cached value, if `ledger_index` is passed only a value read at that ledger counts\n
+        `max_age` in seconds rejects values cached longer ago than that"""
+        entry = self._entries.get(key)
+        if entry is None or ledger_index is not None and entry[0] != ledger_index:
+            return None
+        if max_age is not None and time.monotonic() - entry[1] > max_age:
+            return None
+        return entry[2]
+
+    def set(self, key, ledger_index: int, value) -> None:
+        if key not in self._entries and len(self._entries) >= self.max_entries:
+            # drop the oldest inserted key
+            self._entries.pop(next(iter(self._entries)))
+        self._entries[key] = (ledger_index, time.monotonic(), value)
+
+    def clear(self) -> None:
+        self._entries.clear()
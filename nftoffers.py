@@ -13,18 +13,24 @@ from misc import (
 )
 from x_constants import NFTOKEN_OFFER_FLAGS
 import asyncio
-from typing import Union
-from xrpl.asyncio.clients import AsyncJsonRpcClient
+import time
+from typing import Callable, Union
+from xrpl.asyncio.clients import AsyncJsonRpcClient, AsyncWebsocketClient
 import requests
 from xrpl.clients import JsonRpcClient
-from xrpl.models import (AccountObjects, IssuedCurrencyAmount, NFTBuyOffers,
+from xrpl.models import (AccountObjects, IssuedCurrencyAmount,
                          NFTokenAcceptOffer, NFTokenCancelOffer,
-                         NFTokenCreateOffer, NFTokenCreateOfferFlag,
-                         NFTSellOffers)
-from xrpl.utils import drops_to_xrp, ripple_time_to_datetime, xrp_to_drops
+                         NFTokenCreateOffer, NFTokenCreateOfferFlag)
+from xrpl.models.requests import GenericRequest
+from xrpl.utils import drops_to_xrp, posix_to_ripple_time, ripple_time_to_datetime, xrp_to_drops
+from xrpl.wallet import Wallet
 
-from misc import mm
+from misc import gather_limited, mm
 from x_constants import M_SOURCE_TAG
+from transactions import AccountSequence, SubmitTracker, sign_transactions
+
+# most offers one NFTokenCancelOffer may list
+NFT_OFFER_CANCEL_MAX = 500
 
 # region POST
 def create_nft_sell_offer(sender_addr: str, nftoken_id: str, get: Union[float, IssuedCurrencyAmount], expiry_date: int = None, receiver: str = None, fee: str = None) -> dict:
@@ -39,7 +45,7 @@ def create_nft_sell_offer(sender_addr: str, nftoken_id: str, get: Union[float, I
         expiration=expiry_date,
         destination=receiver,
         flags=NFTokenCreateOfferFlag.TF_SELL_NFTOKEN, fee=fee, memos=mm(), source_tag=M_SOURCE_TAG)
-    return txn.to_dict()
+    return txn.to_xrpl()
 
 def create_nft_buy_offer(sender_addr: str, nftoken_id: str, give: Union[float, IssuedCurrencyAmount], expiry_date: int = None, receiver: str = None, fee: str = None) -> dict:
     """create an nft buy offer, receiver is the account you want to match this offer"""
@@ -80,12 +86,22 @@ def cancel_nft_offer(sender_addr: str, nftoken_offer_ids: list[str], fee: str =
 
 # region GET
 
+def nft_offer_id_from_meta(meta: dict) -> str:
+    """return the id of the nft offer a validated NFTokenCreateOffer created"""
+    if "offer_id" in meta:
+        return meta["offer_id"]
+    for node in meta.get("AffectedNodes", []):
+        created = node.get("CreatedNode", {})
+        if created.get("LedgerEntryType") == "NFTokenOffer":
+            return created["LedgerIndex"]
+    return ""
+
 def parse_nft_offer_flags(offer_flag: int) -> list:
     flags = []
     for flag in NFTOKEN_OFFER_FLAGS:
         if flag["hex"] & offer_flag == flag["hex"]:
             flags.append(flag)
-    return flag
+    return flags
 
 async def account_nft_offers(url: str, wallet_addr: str, mainnet: bool = True) -> dict:
     """return all nft offers an account has created and received"""
@@ -119,68 +135,77 @@ async def account_nft_offers(url: str, wallet_addr: str, mainnet: bool = True) -
             offers.append(offer)
     return offers
 
-async def all_nft_offers(url: str, nftoken_id: str) -> dict:
-    """return all available nft offers to buy and sell an nft"""
-    offer_dict = {}
-    buy = []
-    sell = []
-    buy_req = NFTBuyOffers(nft_id=nftoken_id, id="validated")
-    buy_response = await AsyncJsonRpcClient(url).request(buy_req)
-    buy_result = buy_response.result
-    if "offers" in buy_result:
-        buy_offers = buy_result["offers"]
-        for buy_offer in buy_offers:
-            offer = {}
-            offer["offer_id"] = buy_offer["nft_offer_index"]
-            offer["nftoken_id"] = buy_result["nft_id"]
-            offer["owner"] = buy_offer["owner"]
-            offer["flag"] = buy_offer["flags"]
-            offer["expiry_date"] = ""
-            offer["receiver"] = ""
-            if isinstance(buy_offer["amount"], str):
-                offer["token"] = "XRP"
-                offer["issuer"] = ""
-                offer["amount"] = str(drops_to_xrp(buy_offer["Amount"]))
-            if isinstance(buy_offer["amount"], dict):
-                offer["token"] = buy_offer["amount"]["currency"]
-                offer["issuer"] = buy_offer["amount"]["issuer"]
-                offer["amount"] = buy_offer["amount"]["value"]
-            if "Destination" in buy_offer:
-                offer["receiver"] = buy_offer["Destination"]
-            if "Expiration" in buy_offer:
-                offer["expiry_date"] = str(ripple_time_to_datetime(buy_offer["Expiration"]))
-            buy.append(offer)
-
-    sell_req = NFTSellOffers(nft_id=nftoken_id, id="validated")
-    sell_response = await AsyncJsonRpcClient(url).request(sell_req)
-    sell_result = sell_response.result
-    if "offers" in sell_result:
-        sell_offers = sell_result["offers"]
-        for sell_offer in sell_offers:
-            offer = {}
-            offer["offer_id"] = sell_offer["nft_offer_index"]
-            offer["nftoken_id"] = sell_result["nft_id"]
-            offer["owner"] = sell_offer["owner"]
-            offer["flag"] = sell_offer["flags"]
-            offer["expiry_date"] = ""
-            offer["receiver"] = ""
-            if isinstance(sell_offer["amount"], str):
-                offer["token"] = "XRP"
-                offer["issuer"] = ""
-                offer["amount"] = str(drops_to_xrp(sell_offer["amount"]))
-            if isinstance(sell_offer["amount"], dict):
-                offer["token"] = sell_offer["amount"]["currency"]
-                offer["issuer"] = sell_offer["amount"]["issuer"]
-                offer["amount"] = sell_offer["amount"]["value"]
-            if "destination" in sell_offer:
-                offer["receiver"] = sell_offer["destination"]
-            if "expiration" in sell_offer:
-                offer["expiry_date"] = str(ripple_time_to_datetime(sell_offer["expiration"]))
-            sell.append(offer)
-
-    offer_dict["buy"] = buy
-    offer_dict["sell"] = sell
-    return offer_dict
+def parse_nft_offer(offer: dict, nftoken_id: str) -> dict:
+    """compact record of an nft_buy_offers / nft_sell_offers entry"""
+    record = {
+        "offer_id": offer["nft_offer_index"],
+        "nftoken_id": nftoken_id,
+        "owner": offer["owner"],
+        "flag": offer["flags"],
+        "expiry_date": str(ripple_time_to_datetime(offer["expiration"])) if "expiration" in offer else "",
+        "receiver": offer.get("destination", ""),
+    }
+    if isinstance(offer["amount"], str):
+        record["token"] = "XRP"
+        record["issuer"] = ""
+        record["amount"] = str(drops_to_xrp(offer["amount"]))
+    else:
+        record["token"] = offer["amount"]["currency"]
+        record["issuer"] = offer["amount"]["issuer"]
+        record["amount"] = offer["amount"]["value"]
+    return record
+
+
+async def account_nft_offer_objects(url: str, wallet_addr: str) -> list:
+    """return every NFTokenOffer ledger object an account owns, all pages"""
+    client = AsyncJsonRpcClient(url)
+    objects = []
+    marker = None
+    while True:
+        req = AccountObjects(account=wallet_addr, ledger_index="validated", type="nft_offer", limit=400, marker=marker)
+        result = (await client.request(req)).result
+        objects.extend(result.get("account_objects", []))
+        marker = result.get("marker")
+        if marker is None:
+            return objects
+
+
+async def nft_offers_side(client, nftoken_id: str, side: str, limit: int = 500, raw: bool = False) -> list:
+    """every buy or sell offer of an nft, following markers, over an existing json rpc or websocket client\n
+    `raw` returns the offers as the node sent them instead of parsed records"""
+    offers = []
+    marker = None
+    while True:
+        # the nft_buy_offers / nft_sell_offers request models have no limit or marker
+        params = {"nft_id": nftoken_id, "ledger_index": "validated", "limit": limit}
+        if marker is not None:
+            params["marker"] = marker
+        result = (await client.request(GenericRequest(method=f"nft_{side}_offers", **params))).result
+        if "offers" not in result:
+            # an nft without offers on a side comes back as objectNotFound
+            if result.get("error") == "objectNotFound":
+                return offers
+            raise ValueError(f"nft_{side}_offers failed: {result.get('error', '')}")
+        offers.extend(offer if raw else parse_nft_offer(offer, nftoken_id) for offer in result["offers"])
+        marker = result.get("marker")
+        if marker is None:
+            return offers
+
+
+async def all_nft_offers(url: str, nftoken_id: str, client=None) -> dict:
+    """return all available nft offers to buy and sell an nft\n
+    both sides are read at the same time; pass `client` to reuse an open connection"""
+    client = client or AsyncJsonRpcClient(url)
+    buy, sell = await asyncio.gather(nft_offers_side(client, nftoken_id, "buy"), nft_offers_side(client, nftoken_id, "sell"))
+    return {"buy": buy, "sell": sell}
+
+
+async def all_nft_offers_batch(ws_url: str, nftoken_ids: list, limit: int = 10) -> dict:
+    """`all_nft_offers` for many nfts over one websocket, {nftoken id: {buy, sell}}\n
+    `limit` nfts are in flight at once, each with both sides requested together"""
+    async with AsyncWebsocketClient(ws_url) as client:
+        results = await gather_limited((all_nft_offers(ws_url, nftoken_id, client) for nftoken_id in nftoken_ids), limit)
+    return dict(zip(nftoken_ids, results))
 
 
 # external
@@ -212,4 +237,54 @@ async def nft_offer_info(offer_id: str, mainnet: bool = True) -> dict:
 
 
 
-# endregion
\ No newline at end of file
+# endregion
+
+
+# region SWEEP
+
+
+def nft_offer_expired(offer: dict, now: int = None) -> bool:
+    """whether an NFTokenOffer ledger object has passed its Expiration, `now` in ripple time"""
+    now = posix_to_ripple_time(int(time.time())) if now is None else now
+    return "Expiration" in offer and offer["Expiration"] <= now
+
+
+def cancel_nft_offer_batches(sender_addr: str, nftoken_offer_ids: list, fee: str = None) -> list:
+    """NFTokenCancelOffer transactions for any number of offers, NFT_OFFER_CANCEL_MAX per transaction"""
+    return [
+        cancel_nft_offer(sender_addr, nftoken_offer_ids[i:i + NFT_OFFER_CANCEL_MAX], fee=fee)
+        for i in range(0, len(nftoken_offer_ids), NFT_OFFER_CANCEL_MAX)
+    ]
+
+
+async def sweep_nft_offers(
+    url: str,
+    ws_url: str,
+    wallet: Wallet,
+    select: Callable[[dict], bool] = None,
+    fee: str = "12",
+) -> dict:
+    """cancel an account's expired, or `select`ed, nft offers to free their owner reserve\n
+    `select` gets each NFTokenOffer ledger object and returns True to cancel it, default is expired offers.
+    offers are packed NFT_OFFER_CANCEL_MAX to a transaction and all transactions are submitted without waiting on each other\n
+    returns found, selected, cancelled and per transaction {hash, result, offers}"""
+    select = select or nft_offer_expired
+    offers = await account_nft_offer_objects(url, wallet.address)
+    selected = [offer["index"] for offer in offers if select(offer)]
+    summary = {"found": len(offers), "selected": len(selected), "cancelled": 0, "transactions": []}
+    if not selected:
+        return summary
+    txs = cancel_nft_offer_batches(wallet.address, selected, fee=fee)
+    sequence = AccountSequence(url, wallet.address)
+    async with SubmitTracker(ws_url, on_ledger=sequence.set_ledger_index) as tracker:
+        signed = await asyncio.to_thread(sign_transactions, await sequence.fill_many(txs, fee), wallet)
+        outcomes = await tracker.submit_many(signed)
+    for tx, outcome in zip(txs, outcomes):
+        count = len(tx["NFTokenOffers"])
+        summary["transactions"].append({"hash": outcome["hash"], "result": outcome["result"], "offers": count})
+        if outcome["result"] == "tesSUCCESS":
+            summary["cancelled"] += count
+    return summary
+
+
+# endregion
@@ -1,3 +1,16 @@
+import asyncio
+import base64
+import heapq
+import json
+import os
+import re
+import time
+from hashlib import sha256
+from typing import Iterable, Union
+from urllib.parse import unquote_to_bytes, urlsplit
+
+import httpx
+
 from xrpl.models import (
     NFTokenMint,
     NFTokenBurn,
@@ -7,18 +20,22 @@ from xrpl.models import (
     NFTokenCreateOffer,
     NFTokenCreateOfferFlag,
     Memo,
+    Subscribe,
 )
+from xrpl.models.requests import GenericRequest
 from xrpl.utils import (
     drops_to_xrp,
     ripple_time_to_datetime,
     xrp_to_drops,
     datetime_to_ripple_time,
 )
-from xrpl.asyncio.clients import AsyncJsonRpcClient
+from xrpl.asyncio.clients import AsyncJsonRpcClient, AsyncWebsocketClient
 from xrpl.transaction.main import sign_and_submit
+from xrpl.utils import get_nftoken_id, parse_nftoken_id, posix_to_ripple_time
 import requests
 
 from misc import (
+    gather_limited,
     memo_builder,
     validate_hex_to_symbol,
     validate_symbol_to_hex,
@@ -26,8 +43,11 @@ from misc import (
     nft_fee_to_xrp_format,
     xrp_format_to_nft_fee,
 )
-from x_constants import M_SOURCE_TAG, NFTOKEN_FLAGS
+from x_constants import M_SOURCE_TAG, NFTOKEN_FLAGS, XURLS_
 from xrpl.wallet import Wallet
+from nftoffers import create_nft_sell_offer, nft_offer_id_from_meta, nft_offers_side
+from tickets import TicketPool
+from transactions import UNKNOWN_RESULTS, AccountSequence, SubmitTracker, append_journal, journal_pending, load_journal, resolve_pending, sign_transactions
 
 # https://xrpl.org/docs/concepts/tokens/nfts
 # https://xrpl.org/docs/references/protocol/data-types/nftoken
@@ -63,7 +83,7 @@ def issue_nft(
         nftoken_taxon=taxon,
         uri=validate_symbol_to_hex(uri),
         flags=flag,
-        transfer_fee=nft_fee_to_xrp_format(transfer_fee),
+        transfer_fee=nft_fee_to_xrp_format(transfer_fee) if transfer_fee is not None else None,
         fee=fee,
         memos=mm(),
         source_tag=M_SOURCE_TAG,
@@ -89,6 +109,111 @@ def burn_nft(
 # endregion
 
 
+# region MINT
+
+
+async def mint_nft_collection(
+    url: str,
+    ws_url: str,
+    minter: Wallet,
+    items: Iterable[Union[str, dict]],
+    taxon: int,
+    is_transferable: bool = True,
+    only_xrp: bool = False,
+    issuer_burn: bool = False,
+    transfer_fee: float = None,
+    journal_path: str = None,
+    concurrency: int = 50,
+    fee: str = "12",
+) -> list:
+    """mint a collection in parallel from a pool of tickets and optionally list each nft for sale\n
+    items are uris or dicts {"uri": ..., "price": xrp} - items with a price get a sell offer once minted\n
+    `concurrency` nfts are minted per round; every transaction is journaled as pending before it is submitted
+    and every round with its outcomes, so a rerun with the same journal first settles what was in flight from the
+    ledger, then only mints what is missing and lists what was minted but not listed\n
+    returns one record per item: uri, nftoken_id, offer_id, result"""
+    journal = load_journal(journal_path)
+    sequence = AccountSequence(url, minter.address)
+    records = []
+
+    def apply_outcome(record: dict, outcome: dict) -> None:
+        stage = record.pop("pending")["stage"]
+        record["result"] = outcome["result"]
+        if outcome["result"] == "tesSUCCESS" and stage == "mint":
+            record["nftoken_id"] = outcome["meta"].get("nftoken_id") or get_nftoken_id(outcome["meta"])
+        elif outcome["result"] == "tesSUCCESS":
+            record["offer_id"] = nft_offer_id_from_meta(outcome["meta"])
+
+    pending = {key: record for key, record in journal.items() if record["result"] == "pending"}
+    if pending:
+        # mints or listings submitted by a run that stopped before recording their outcome
+        for key, outcome in (await resolve_pending(url, {key: record["pending"] for key, record in pending.items()})).items():
+            apply_outcome(pending[key], outcome)
+        append_journal(journal_path, list(pending.values()))
+
+    async def submit_ticket_create(tx: dict) -> None:
+        signed = sign_transactions([await sequence.fill(tx, fee)], minter)
+        outcome = await (await tracker.submit(signed[0]))
+        if outcome["result"] != "tesSUCCESS":
+            raise RuntimeError(f"TicketCreate failed: {outcome['result']}")
+
+    async def submit_with_tickets(batch: list, txs: list, stage: str) -> None:
+        filled = [await pool.fill(tx, fee) for tx in txs]
+        for tx in filled:
+            tx["LastLedgerSequence"] = sequence.ledger_index() + sequence.ledger_offset
+        signed = await asyncio.to_thread(sign_transactions, filled, minter)
+        # lower bound of the ledgers these can land in, with room for a ledger estimate that ran ahead
+        ledger_index = sequence.ledger_index() - sequence.ledger_offset
+        for record, tx in zip(batch, signed):
+            record["pending"] = journal_pending({"key": record["key"], "stage": stage}, tx, ledger_index)
+            record["result"] = "pending"
+        # journaled before submitting so a crash can't lose what was minted
+        append_journal(journal_path, batch)
+        outcomes = await tracker.submit_many(signed)
+        unknown = {record["key"]: record["pending"] for record, outcome in zip(batch, outcomes) if outcome["result"] in UNKNOWN_RESULTS}
+        if unknown:
+            resolved = await resolve_pending(url, unknown)
+            outcomes = [resolved.get(record["key"], outcome) for record, outcome in zip(batch, outcomes)]
+        for tx, record, outcome in zip(filled, batch, outcomes):
+            # tec results still consume the ticket
+            await pool.release(tx["TicketSequence"], used=outcome["validated"])
+            apply_outcome(record, outcome)
+
+    async def mint_round(batch: list) -> None:
+        to_mint = [record for record in batch if not record["nftoken_id"]]
+        if to_mint:
+            txs = [issue_nft(minter.address, taxon, is_transferable, only_xrp, issuer_burn, transfer_fee=transfer_fee, uri=record["uri"]) for record in to_mint]
+            await submit_with_tickets(to_mint, txs, "mint")
+        to_list = [record for record in batch if record["nftoken_id"] and record["price"] is not None and not record["offer_id"]]
+        if to_list:
+            txs = [create_nft_sell_offer(minter.address, record["nftoken_id"], float(record["price"])) for record in to_list]
+            await submit_with_tickets(to_list, txs, "offer")
+        append_journal(journal_path, batch)
+
+    async with SubmitTracker(ws_url, on_ledger=sequence.set_ledger_index) as tracker:
+        pool = TicketPool(url, minter.address, submit_ticket_create, low_watermark=concurrency, batch_size=max(concurrency * 2, 50), fee=fee)
+        await pool.load()
+        batch = []
+        for index, item in enumerate(items):
+            item = {"uri": item} if isinstance(item, str) else item
+            key = f"{index}:{item['uri']}"
+            record = journal.get(key, {"key": key, "uri": item["uri"], "nftoken_id": "", "offer_id": "", "result": ""})
+            record["price"] = item.get("price")
+            records.append(record)
+            if record["nftoken_id"] and (record["price"] is None or record["offer_id"]):
+                continue
+            batch.append(record)
+            if len(batch) >= concurrency:
+                await mint_round(batch)
+                batch = []
+        if batch:
+            await mint_round(batch)
+    return records
+
+
+# endregion
+
+
 # region GET
 
 
@@ -180,6 +305,358 @@ async def created_nfts(wallet_addr: str, mainnet: bool = True) -> list:
 # endregion
 
 
+
+# region INDEX
+
+
+class NFTCollectionIndex:
+    """local index of the nfts one issuer minted, grouped by taxon, with their owners and open xrp sell offers\n
+    `load` reads the collection once (clio's nfts_by_issuer), `watch` then follows mints, burns, transfers and offers
+    on the issuer's and holders' account streams; `save` / `open` persist it so stats never need a full re-download.
+    only public xrp sell offers count towards the floor"""
+
+    def __init__(self, issuer: str):
+        self.issuer = issuer
+        self.nfts = {}  # nft id: {taxon, owner, transfer_fee, serial, uri}
+        self.offers = {}  # offer id: {nft_id, owner, amount (drops), expiration}
+        self.ledger_index = None
+
+    def add_nft(self, nftoken_id: str, owner: str, uri: str = "") -> None:
+        token = parse_nftoken_id(nftoken_id)
+        if token["issuer"] != self.issuer:
+            return
+        self.nfts[nftoken_id] = {
+            "taxon": token["taxon"],
+            "owner": owner,
+            "transfer_fee": xrp_format_to_nft_fee(token["transfer_fee"]),
+            "serial": token["sequence"],
+            "uri": uri,
+        }
+
+    def add_offer(self, offer_id: str, nftoken_id: str, owner: str, amount, flags: int, expiration: int = None, destination: str = None) -> None:
+        # buy, token and private offers can't set a public floor
+        if nftoken_id in self.nfts and flags & 1 and isinstance(amount, str) and not destination:
+            self.offers[offer_id] = {"nft_id": nftoken_id, "owner": owner, "amount": int(amount), "expiration": expiration}
+
+    async def load(self, url: str, with_offers: bool = True, limit: int = 10) -> int:
+        """read every live nft of the issuer and, unless `with_offers` is False, their sell offers; returns the nft count\n
+        nfts_by_issuer is a clio method, point `url` at a clio server"""
+        client = AsyncJsonRpcClient(url)
+        marker = None
+        while True:
+            params = {"issuer": self.issuer, "ledger_index": "validated", "limit": 400}
+            if marker is not None:
+                params["marker"] = marker
+            result = (await client.request(GenericRequest(method="nfts_by_issuer", **params))).result
+            if "nfts" not in result:
+                raise ValueError(f"nfts_by_issuer failed: {result.get('error', '')}")
+            self.ledger_index = result.get("ledger_index", self.ledger_index)
+            for nft in result["nfts"]:
+                if not nft.get("is_burned"):
+                    self.add_nft(nft["nft_id"], nft["owner"], validate_hex_to_symbol(nft["uri"]) if nft.get("uri") else "")
+            marker = result.get("marker")
+            if marker is None:
+                break
+        if with_offers:
+            nft_ids = list(self.nfts)
+            sides = await gather_limited((nft_offers_side(client, nft_id, "sell", raw=True) for nft_id in nft_ids), limit)
+            for nft_id, offers in zip(nft_ids, sides):
+                for offer in offers:
+                    self.add_offer(offer["nft_offer_index"], nft_id, offer["owner"], offer["amount"], offer["flags"], offer.get("expiration"), offer.get("destination"))
+        return len(self.nfts)
+
+    def apply_transaction(self, message: dict) -> list:
+        """update the index from a validated transaction stream message, returns accounts that became holders"""
+        tx = message["tx_json"] if "tx_json" in message else message["transaction"]
+        meta = message.get("meta", {})
+        if meta.get("TransactionResult") != "tesSUCCESS":
+            return []
+        new_owners = []
+        if "ledger_index" in message:
+            self.ledger_index = message["ledger_index"]
+        tx_type = tx["TransactionType"]
+        if tx_type == "NFTokenMint":
+            self.add_nft(meta.get("nftoken_id") or get_nftoken_id(meta), tx["Account"], validate_hex_to_symbol(tx["URI"]) if "URI" in tx else "")
+        elif tx_type == "NFTokenBurn":
+            self.nfts.pop(tx["NFTokenID"], None)
+        created, deleted = [], []
+        for node in meta.get("AffectedNodes", []):
+            kind, entry = next(iter(node.items()))
+            if entry.get("LedgerEntryType") != "NFTokenOffer":
+                continue
+            if kind == "CreatedNode":
+                created.append((entry["LedgerIndex"], entry["NewFields"]))
+            elif kind == "DeletedNode":
+                deleted.append(entry["FinalFields"])
+                self.offers.pop(entry["LedgerIndex"], None)
+        for offer_id, fields in created:
+            self.add_offer(offer_id, fields["NFTokenID"], fields["Owner"], fields["Amount"], fields.get("Flags", 0), fields.get("Expiration"), fields.get("Destination"))
+        if tx_type == "NFTokenAcceptOffer":
+            # the buy offer's owner gets the nft, with only a sell offer the account accepting it does
+            buyers = [fields["Owner"] for fields in deleted if not fields.get("Flags", 0) & 1]
+            nft_ids = [fields["NFTokenID"] for fields in deleted]
+            nftoken_id = meta.get("nftoken_id") or (nft_ids[0] if nft_ids else None)
+            if nftoken_id in self.nfts:
+                self.nfts[nftoken_id]["owner"] = buyers[0] if buyers else tx["Account"]
+                new_owners.append(self.nfts[nftoken_id]["owner"])
+        return new_owners
+
+    async def watch(self, ws_url: str, save_path: str = None, save_every: int = 60) -> None:
+        """follow the issuer and every holder's transactions, runs until cancelled\n
+        with `save_path` the index is saved at most every `save_every` seconds"""
+        async with AsyncWebsocketClient(ws_url) as client:
+            subscribed = {self.issuer} | {nft["owner"] for nft in self.nfts.values()}
+            await client.request(Subscribe(accounts=sorted(subscribed)))
+            saved = time.monotonic()
+            async for message in client:
+                if message.get("type") != "transaction" or not message.get("validated"):
+                    continue
+                new_owners = [owner for owner in self.apply_transaction(message) if owner not in subscribed]
+                if new_owners:
+                    subscribed.update(new_owners)
+                    await client.request(Subscribe(accounts=new_owners))
+                if save_path is not None and time.monotonic() - saved > save_every:
+                    self.save(save_path)
+                    saved = time.monotonic()
+
+    def save(self, path: str) -> None:
+        """write the index to a json file, replaced atomically"""
+        with open(path + ".tmp", "w") as file:
+            json.dump({"issuer": self.issuer, "ledger_index": self.ledger_index, "nfts": self.nfts, "offers": self.offers}, file)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def open(cls, path: str) -> "NFTCollectionIndex":
+        """load an index written by `save`"""
+        with open(path) as file:
+            data = json.load(file)
+        index = cls(data["issuer"])
+        index.ledger_index = data["ledger_index"]
+        index.nfts = data["nfts"]
+        index.offers = data["offers"]
+        return index
+
+    def live_offers(self, now: int = None) -> Iterable[tuple]:
+        """(taxon, drops, offer id, nft id) of every sell offer that can still be accepted"""
+        now = posix_to_ripple_time(int(time.time())) if now is None else now
+        for offer_id, offer in self.offers.items():
+            nft = self.nfts.get(offer["nft_id"])
+            # an offer left behind by a previous owner can't be accepted
+            if nft is None or nft["owner"] != offer["owner"]:
+                continue
+            if offer["expiration"] is not None and offer["expiration"] <= now:
+                continue
+            yield nft["taxon"], offer["amount"], offer_id, offer["nft_id"]
+
+    def floor(self, taxon: int = None, now: int = None, count: int = 1) -> list:
+        """the `count` cheapest live sell offers, of one taxon or the whole collection, cheapest first"""
+        candidates = ((amount, offer_id, nft_id) for offer_taxon, amount, offer_id, nft_id in self.live_offers(now) if taxon is None or offer_taxon == taxon)
+        return [
+            {"offer_id": offer_id, "nft_id": nft_id, "amount": str(drops_to_xrp(str(amount)))}
+            for amount, offer_id, nft_id in heapq.nsmallest(count, candidates)
+        ]
+
+    def collection_stats(self, now: int = None) -> list:
+        """per taxon: count, owners, top holders, transfer fee distribution and floor"""
+        taxa = {}
+        for nft in self.nfts.values():
+            stats = taxa.setdefault(nft["taxon"], {"taxon": nft["taxon"], "count": 0, "holdings": {}, "transfer_fees": {}})
+            stats["count"] += 1
+            stats["holdings"][nft["owner"]] = stats["holdings"].get(nft["owner"], 0) + 1
+            stats["transfer_fees"][nft["transfer_fee"]] = stats["transfer_fees"].get(nft["transfer_fee"], 0) + 1
+        floors = {}
+        for taxon, amount, offer_id, nft_id in self.live_offers(now):
+            if taxon not in floors or amount < floors[taxon][0]:
+                floors[taxon] = (amount, offer_id, nft_id)
+        result = []
+        for taxon in sorted(taxa):
+            stats = taxa[taxon]
+            holdings = stats.pop("holdings")
+            stats["owners"] = len(holdings)
+            stats["top_holders"] = heapq.nlargest(10, holdings.items(), key=lambda holding: holding[1])
+            stats["floor"] = None
+            if taxon in floors:
+                amount, offer_id, nft_id = floors[taxon]
+                stats["floor"] = {"offer_id": offer_id, "nft_id": nft_id, "amount": str(drops_to_xrp(str(amount)))}
+            result.append(stats)
+        return result
+
+
+# endregion
+
+
+
+# region METADATA
+
+# an ipfs cid: v0 is base58 starting Qm, v1 is base32 starting b (bafy..., bafk...)
+IPFS_CID = re.compile(r"Qm[1-9A-HJ-NP-Za-km-z]{44}|b[a-z2-7]{58,}")
+
+
+def metadata_location(uri: str, ipfs_gateway: str = XURLS_["IPFS_GATEWAY"], arweave_gateway: str = XURLS_["ARWEAVE_GATEWAY"]) -> dict:
+    """where the metadata behind a decoded nft uri lives: {url, immutable, key}\n
+    ipfs and arweave content never changes so it can be cached for good, plain http(s) can.
+    `key` names the content independent of the gateway it is read through, ipfs/<cid>/<path> or ar/<id>/<path>,
+    and is the url itself for plain http(s)"""
+    uri = uri.strip()
+    if uri.startswith("ipfs://"):
+        path = uri[len("ipfs://"):]
+        path = path[len("ipfs/"):] if path.startswith("ipfs/") else path
+        return {"url": ipfs_gateway + path, "immutable": True, "key": "ipfs/" + path}
+    if uri.startswith("ar://"):
+        path = uri[len("ar://"):]
+        return {"url": arweave_gateway + path, "immutable": True, "key": "ar/" + path}
+    if IPFS_CID.fullmatch(uri.split("?")[0].split("/")[0]):
+        # a bare cid, possibly with a path inside it
+        return {"url": ipfs_gateway + uri, "immutable": True, "key": "ipfs/" + uri}
+    if uri.startswith(("http://", "https://")):
+        if "/ipfs/" in uri:
+            # a gateway url, the same content as ipfs://<cid>/<path>
+            return {"url": uri, "immutable": True, "key": "ipfs/" + uri.split("/ipfs/", 1)[1]}
+        return {"url": uri, "immutable": False, "key": uri}
+    return {"url": "", "immutable": False, "key": ""}
+
+
+def decode_data_uri(uri: str) -> bytes:
+    """content of a data: uri"""
+    header, _, data = uri.partition(",")
+    return base64.b64decode(data) if header.endswith(";base64") else unquote_to_bytes(data)
+
+
+class NFTMetadataResolver:
+    """fetch the metadata behind nft uris concurrently, with a limit per host and overall, and cache it on disk\n
+    cache files are named by the sha256 of the content's `metadata_location` key, so one cid is cached once whichever
+    form or gateway it is reached through; ipfs / arweave content is kept for good,
+    http content for `http_ttl` seconds. pass `gateway` (and `transport`, e.g httpx.MockTransport) to run against
+    a local stand-in instead of a public gateway"""
+
+    def __init__(
+        self,
+        cache_dir: str = None,
+        gateway: str = XURLS_["IPFS_GATEWAY"],
+        per_host: int = 4,
+        limit: int = 32,
+        timeout: float = 10.0,
+        max_bytes: int = 5_000_000,
+        http_ttl: float = 3600,
+        transport: httpx.AsyncBaseTransport = None,
+    ):
+        self.cache_dir = cache_dir
+        self.gateway = gateway
+        self.per_host = per_host
+        self.max_bytes = max_bytes
+        self.http_ttl = http_ttl
+        self.client = httpx.AsyncClient(
+            timeout=timeout, follow_redirects=True, transport=transport,
+            limits=httpx.Limits(max_connections=limit),
+        )
+        self._limit = asyncio.Semaphore(limit)
+        self._hosts = {}
+        self._inflight = {}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.close()
+
+    def cache_path(self, key: str) -> str:
+        digest = sha256(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def cached(self, key: str, immutable: bool) -> bytes:
+        if self.cache_dir is None:
+            return None
+        path = self.cache_path(key)
+        try:
+            if not immutable and time.time() - os.path.getmtime(path) > self.http_ttl:
+                return None
+            with open(path, "rb") as file:
+                return file.read()
+        except OSError:
+            return None
+
+    def store(self, key: str, content: bytes) -> None:
+        if self.cache_dir is None:
+            return
+        path = self.cache_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as file:
+            file.write(content)
+        os.replace(path + ".tmp", path)
+
+    async def download(self, url: str) -> bytes:
+        host = urlsplit(url).netloc
+        semaphore = self._hosts.setdefault(host, asyncio.Semaphore(self.per_host))
+        # wait on the host first so requests queued for a busy host do not hold global slots
+        async with semaphore, self._limit:
+            async with self.client.stream("GET", url) as response:
+                response.raise_for_status()
+                chunks = []
+                size = 0
+                async for chunk in response.aiter_bytes():
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise ValueError(f"metadata larger than {self.max_bytes} bytes")
+                    chunks.append(chunk)
+        return b"".join(chunks)
+
+    async def fetch_content(self, url: str, immutable: bool, key: str = None) -> bytes:
+        key = key or url
+        content = self.cached(key, immutable)
+        if content is not None:
+            return content
+        # the same content asked for twice at once is downloaded once
+        if key not in self._inflight:
+            self._inflight[key] = asyncio.ensure_future(self.download(url))
+        try:
+            content = await asyncio.shield(self._inflight[key])
+        finally:
+            if key in self._inflight and self._inflight[key].done():
+                del self._inflight[key]
+        self.store(key, content)
+        return content
+
+    async def resolve(self, uri: str) -> dict:
+        """metadata behind one decoded uri: {uri, url, metadata, error}, metadata is parsed json or None"""
+        record = {"uri": uri, "url": "", "metadata": None, "error": ""}
+        try:
+            if uri.startswith("data:"):
+                content = decode_data_uri(uri)
+            else:
+                location = metadata_location(uri, self.gateway)
+                record["url"] = location["url"]
+                if not location["url"]:
+                    record["error"] = "unsupported uri"
+                    return record
+                content = await self.fetch_content(location["url"], location["immutable"], location["key"])
+            record["metadata"] = json.loads(content)
+        except (httpx.HTTPError, ValueError, OSError) as e:
+            record["error"] = str(e) or type(e).__name__
+        return record
+
+    async def resolve_many(self, uris: Iterable[str]) -> list:
+        """`resolve` many uris at once, results keep the input order"""
+        return list(await asyncio.gather(*(self.resolve(uri) for uri in uris)))
+
+
+async def nfts_with_metadata(nfts: list, resolver: NFTMetadataResolver) -> list:
+    """add `metadata` to nft records from `account_nfts`, `created_nfts` etc, records without a uri get None"""
+    with_uri = [nft for nft in nfts if nft.get("uri")]
+    for nft, record in zip(with_uri, await resolver.resolve_many(nft["uri"] for nft in with_uri)):
+        nft["metadata"] = record["metadata"]
+    for nft in nfts:
+        nft.setdefault("metadata", None)
+    return nfts
+
+
+# endregion
+
+
 # from xrpl.models.transactions import Transaction
 # from xrpl.clients import JsonRpcClient
 
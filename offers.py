@@ -6,12 +6,12 @@ from xrpl.utils import (
     xrp_to_drops,
     datetime_to_ripple_time,
 )
-from xrpl.models import (AccountOffers, OfferCreateFlag, OfferCancel, BookOffers, IssuedCurrency, XRP, OfferCreate, IssuedCurrencyAmount, LedgerEntry)
+from xrpl.models import (AccountOffers, OfferCreateFlag, OfferCancel, BookOffers, IssuedCurrency, XRP, OfferCreate, IssuedCurrencyAmount, LedgerEntry, Ledger)
 from xrpl.models.requests.ledger_entry import Offer
-from typing import Union
-from misc import validate_hex_to_symbol, validate_symbol_to_hex, mm
+from typing import List, Tuple, Union
+from misc import validate_hex_to_symbol, validate_symbol_to_hex, mm, gather_limited
 from x_constants import M_SOURCE_TAG, OFFER_FLAGS
-from xrpl.asyncio.clients import AsyncJsonRpcClient
+from xrpl.asyncio.clients import AsyncJsonRpcClient, AsyncWebsocketClient
 
 
 
@@ -288,44 +288,105 @@ async def offer_info(url: str, offer_id: str = None, offer_creator: str = None,
             )
     return offer_info
 
-async def all_offers(url: str, pay: Union[XRP, IssuedCurrency], receive: Union[XRP, IssuedCurrency]) -> list:
+def parse_book_offer(offer: dict) -> dict:
+    """parse a book_offers entry into the offer dict returned by `all_offers`"""
+    of = {}
+    of["creator"] = offer["Account"]
+    of["offer_id"] = offer["index"]
+    of["sequence"] = offer["Sequence"] # offer id
+    of["rate"] = offer["quality"]
+    of["flags"] = offer["Flags"]
+    of["creator_liquidity"] = ""
+    if "owner_funds" in offer and isinstance(offer["TakerGets"], str):
+        of["creator_liquidity"] = f'{float(drops_to_xrp(offer["owner_funds"]))} XRP' # Amount of the TakerGets currency the side placing the offer has available to be traded.
+    if "owner_funds" in offer and isinstance(offer["TakerGets"], dict):
+        of["creator_liquidity"] = f'{offer["owner_funds"]}  {validate_hex_to_symbol(offer["TakerGets"]["currency"])}' # Amount of the TakerGets currency the side placing the offer has available to be traded.
+    if isinstance(offer["TakerPays"], dict):
+        of["buy_token"] = validate_hex_to_symbol(offer["TakerPays"]["currency"])
+        of["buy_issuer"] = offer["TakerPays"]["issuer"]
+        of["buy_amount"] = offer["TakerPays"]["value"]
+    elif isinstance(offer["TakerPays"], str):
+        of["buy_token"] = "XRP"
+        of["buy_issuer"] = ""
+        of["buy_amount"] = str(drops_to_xrp(offer["TakerPays"]))
+
+    if isinstance(offer["TakerGets"], dict):
+        of["sell_token"] = validate_hex_to_symbol(offer["TakerGets"]["currency"])
+        of["sell_issuer"] = offer["TakerGets"]["issuer"]
+        of["sell_amount"] = offer["TakerGets"]["value"]
+    elif isinstance(offer["TakerGets"], str):
+        of["sell_token"] = "XRP"
+        of["sell_issuer"] = ""
+        of["sell_amount"] = str(drops_to_xrp(offer["TakerGets"]))
+    return of
+
+async def all_offers(url: str, pay: Union[XRP, IssuedCurrency], receive: Union[XRP, IssuedCurrency], ledger_index: Union[int, str] = "validated") -> list:
     """returns all offers for 2 pairs"""
     all_offers_list = []
-    req = BookOffers(taker_gets=pay, taker_pays=receive, ledger_index="validated")
+    req = BookOffers(taker_gets=pay, taker_pays=receive, ledger_index=ledger_index)
     response =await AsyncJsonRpcClient(url).request(req)
     result = response.result
     if "offers" in result:
         offers = result["offers"]
         for offer in offers:
-            of = {}
-            of["creator"] = offer["Account"]
-            of["offer_id"] = offer["index"]
-            of["sequence"] = offer["Sequence"] # offer id
-            of["rate"] = offer["quality"]
-            of["flags"] = offer["Flags"]
-            of["creator_liquidity"] = ""
-            if "owner_funds" in offer and isinstance(offer["TakerGets"], str):
-                of["creator_liquidity"] = f'{float(drops_to_xrp(offer["owner_funds"]))} XRP' # Amount of the TakerGets currency the side placing the offer has available to be traded.
-            if "owner_funds" in offer and isinstance(offer["TakerGets"], dict):
-                of["creator_liquidity"] = f'{offer["owner_funds"]}  {validate_hex_to_symbol(offer["TakerGets"]["currency"])}' # Amount of the TakerGets currency the side placing the offer has available to be traded.
-            if isinstance(offer["TakerPays"], dict):
-                of["buy_token"] = validate_hex_to_symbol(offer["TakerPays"]["currency"])
-                of["buy_issuer"] = offer["TakerPays"]["issuer"]
-                of["buy_amount"] = offer["TakerPays"]["value"]
-            elif isinstance(offer["TakerPays"], str):
-                of["buy_token"] = "XRP"
-                of["buy_issuer"] = ""
-                of["buy_amount"] = str(drops_to_xrp(offer["TakerPays"]))
-
-            if isinstance(offer["TakerGets"], dict):
-                of["sell_token"] = validate_hex_to_symbol(offer["TakerGets"]["currency"])
-                of["sell_issuer"] = offer["TakerGets"]["issuer"]
-                of["sell_amount"] = offer["TakerGets"]["value"]
-            elif isinstance(offer["TakerGets"], str):
-                of["sell_token"] = "XRP"
-                of["sell_issuer"] = ""
-                of["sell_amount"] = str(drops_to_xrp(offer["TakerGets"]))
-            all_offers_list.append(of)
+            all_offers_list.append(parse_book_offer(offer))
     return all_offers_list
 
+async def book_side(client: AsyncWebsocketClient, pay: Union[XRP, IssuedCurrency], receive: Union[XRP, IssuedCurrency], ledger_index: Union[int, str] = "validated") -> list:
+    """returns all offers for 2 pairs at a ledger, over an already open client"""
+    req = BookOffers(taker_gets=pay, taker_pays=receive, ledger_index=ledger_index)
+    response = await client.request(req)
+    result = response.result
+    return [parse_book_offer(offer) for offer in result["offers"]] if "offers" in result else []
+
+async def all_offers_batch(ws_url: str, pairs: List[Tuple[Union[XRP, IssuedCurrency], Union[XRP, IssuedCurrency]]], limit: int = 10) -> dict:
+    """returns both sides of the book for many (pay, receive) pairs over one websocket connection\n
+    every book is read at the same validated ledger so the snapshot is consistent, `limit` caps the requests in flight\n
+    `asks` = offers selling `pay` for `receive` (same as `all_offers`), `bids` = the reverse side"""
+    async with AsyncWebsocketClient(ws_url) as client:
+        response = await client.request(Ledger(ledger_index="validated"))
+        ledger_index = response.result["ledger_index"]
+        sides = await gather_limited(
+            [book_side(client, p, r, ledger_index) for pay, receive in pairs for p, r in ((pay, receive), (receive, pay))],
+            limit,
+        )
+    books = []
+    for i, (pay, receive) in enumerate(pairs):
+        books.append({"pay": pay, "receive": receive, "asks": sides[2 * i], "bids": sides[2 * i + 1]})
+    return {"ledger_index": ledger_index, "books": books}
+
+def order_book_state(offers: Union[list, dict]) -> dict:
+    """key a list of offers from `all_offers` by offer id"""
+    if isinstance(offers, dict):
+        return offers
+    return {offer["offer_id"]: offer for offer in offers}
+
+def diff_order_book(old: Union[list, dict], new: Union[list, dict], sequence: int = 0) -> dict:
+    """compare two book states and return the changes as a patch for subscribers\n
+    `sequence` is the sequence of the patch the client last applied, the returned patch carries `sequence + 1`\n
+    `add` and `modify` hold full offers, `remove` holds offer ids"""
+    old = order_book_state(old)
+    new = order_book_state(new)
+    add = []
+    modify = []
+    for offer_id, offer in new.items():
+        if offer_id not in old:
+            add.append(offer)
+        elif old[offer_id] != offer:
+            modify.append(offer)
+    remove = [offer_id for offer_id in old if offer_id not in new]
+    return {"prev_sequence": sequence, "sequence": sequence + 1, "add": add, "modify": modify, "remove": remove}
+
+def apply_order_book_diff(state: Union[list, dict], diff: dict, sequence: int) -> dict:
+    """apply a patch from `diff_order_book` to a book state keyed by offer id\n
+    `sequence` is the sequence of the last applied patch, a gap raises ValueError and the client should resync with a full book"""
+    if diff["prev_sequence"] != sequence:
+        raise ValueError(f"order book patch {diff['sequence']} does not follow {sequence}")
+    state = dict(order_book_state(state))
+    for offer_id in diff["remove"]:
+        state.pop(offer_id, None)
+    for offer in diff["add"] + diff["modify"]:
+        state[offer["offer_id"]] = offer
+    return state
+
 # endregion
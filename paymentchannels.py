@@ -1,23 +1,28 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import timedelta
 from decimal import Decimal
 
-from typing import Union
+from typing import Dict, List, Union
 
-from xrpl.core.binarycodec import encode_for_signing_claim
 from xrpl.core.keypairs import sign, is_valid_message 
-from xrpl.asyncio.clients import AsyncJsonRpcClient
-from xrpl.models import ( AccountObjects,
+from xrpl.asyncio.clients import AsyncJsonRpcClient, AsyncWebsocketClient
+from xrpl.models import ( AccountObjects, LedgerEntry, Subscribe,
                        PaymentChannelCreate,
                          PaymentChannelFund, ChannelVerify, 
                          PaymentChannelClaim, PaymentChannelClaimFlag, )
-from xrpl.utils import drops_to_xrp, ripple_time_to_datetime, xrp_to_drops, datetime_to_ripple_time
+from xrpl.utils import drops_to_xrp, ripple_time_to_datetime, xrp_to_drops, datetime_to_ripple_time, posix_to_ripple_time
 
 from misc import mm, validate_hex_to_symbol, validate_symbol_to_hex
 
 from x_constants import M_SOURCE_TAG
+from transactions import append_journal, load_journal
 
 # https://xrpl.org/docs/concepts/payment-types/payment-channels
 
+# claims are signed over "CLM\0" + channel id + amount in drops as a 64 bit integer
+CLAIM_PREFIX = "434C4D00"
+
 
 
 # ## region POST
@@ -52,21 +57,114 @@ def close_payment_channel(sender_addr: str, channel_id: str, fee: str = None) ->
 # TODO: modify to match wallet signing requirements
 # requires private key
 def offline_generate_xrp_payment_channel_signature(channel_id: str, amount: Union[int, Decimal, float], private_key: str) -> str:
-    data = encode_for_signing_claim({"channel": channel_id, "amount": xrp_to_drops(amount)})
-    return sign(data, private_key)
+    return sign(claim_signing_data(channel_id, int(xrp_to_drops(amount))), private_key)
 
 def offline_verify_xrp_payment_channel_signature(channel_id: str, amount: Union[int, float, Decimal], public_key: str, signature: str) -> bool:
     """check the validity of a signature that can be used to redeem a specific amount of XRP from a payment channel."""
-    value = False
-    data = encode_for_signing_claim({"channel": channel_id, "amount": xrp_to_drops(amount)})
-    value = is_valid_message(data, signature, public_key)
-    return value
+    return verify_claim(channel_id, int(xrp_to_drops(amount)), public_key, signature)
 
 
 # endregion 
 
 
 
+# region CLAIM
+
+
+def claim_signing_data(channel_id: str, drops: int) -> bytes:
+    """the bytes a claim signature covers, same as encode_for_signing_claim without going through the codec"""
+    return bytes.fromhex(CLAIM_PREFIX + channel_id + format(drops, "016X"))
+
+
+def verify_claim(channel_id: str, drops: int, public_key: str, signature: str) -> bool:
+    """check a claim signature offline, amount in drops"""
+    try:
+        return is_valid_message(claim_signing_data(channel_id, drops), bytes.fromhex(signature), public_key)
+    except ValueError:
+        return False
+
+
+def verify_claim_record(claim: dict) -> bool:
+    return verify_claim(claim["channel_id"], int(claim["amount"]), claim["public_key"], claim["signature"])
+
+
+def verify_claims(claims: List[dict], workers: int = None, chunksize: int = 256) -> List[bool]:
+    """verify many claims {channel_id, amount (drops), public_key, signature} across a process pool, results keep the input order\n
+    batches no bigger than `chunksize` are verified in this process"""
+    if len(claims) <= chunksize:
+        return list(map(verify_claim_record, claims))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(verify_claim_record, claims, chunksize=chunksize))
+
+
+def sign_claim_chunk(prefix: bytes, private_key: str, amounts: List[int]) -> List[str]:
+    return [sign(prefix + drops.to_bytes(8, "big"), private_key) for drops in amounts]
+
+
+class ClaimEngine:
+    """sign claims for the channels whose keys it holds, amounts in drops\n
+    each channel's encoded prefix is built once and its claims only go up:
+    a claim at or below the highest one already signed is refused, since the receiver could redeem either"""
+
+    def __init__(self):
+        self.channels = {}  # channel id: {prefix, private_key, public_key, amount, highest}
+
+    def add_channel(self, channel_id: str, private_key: str, public_key: str, amount: int = None, highest: int = 0) -> None:
+        """hold a channel's keys; `amount` caps claims at what is deposited, `highest` resumes from a claim signed earlier"""
+        self.channels[channel_id] = {
+            "prefix": bytes.fromhex(CLAIM_PREFIX + channel_id),
+            "private_key": private_key,
+            "public_key": public_key,
+            "amount": amount,
+            "highest": highest,
+        }
+
+    def remove_channel(self, channel_id: str) -> None:
+        self.channels.pop(channel_id, None)
+
+    def highest(self, channel_id: str) -> int:
+        return self.channels[channel_id]["highest"]
+
+    def _check(self, channel: dict, channel_id: str, amounts: List[int]) -> None:
+        previous = channel["highest"]
+        for drops in amounts:
+            if drops <= previous:
+                raise ValueError(f"claim of {drops} drops on {channel_id} is not above {previous}")
+            previous = drops
+        if channel["amount"] is not None and previous > channel["amount"]:
+            raise ValueError(f"claim of {previous} drops on {channel_id} is more than the {channel['amount']} deposited")
+
+    def sign(self, channel_id: str, drops: int) -> dict:
+        """sign one claim, returns {channel_id, amount, public_key, signature}"""
+        return self.sign_many(channel_id, [drops])[0]
+
+    def sign_many(self, channel_id: str, amounts: List[int], workers: int = None, chunksize: int = 256) -> List[dict]:
+        """sign increasing claims on one channel, batches larger than `chunksize` across a process pool"""
+        channel = self.channels[channel_id]
+        amounts = [int(drops) for drops in amounts]
+        self._check(channel, channel_id, amounts)
+        if len(amounts) <= chunksize:
+            signatures = sign_claim_chunk(channel["prefix"], channel["private_key"], amounts)
+        else:
+            chunks = [amounts[i:i + chunksize] for i in range(0, len(amounts), chunksize)]
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                signed = pool.map(sign_claim_chunk, [channel["prefix"]] * len(chunks), [channel["private_key"]] * len(chunks), chunks)
+                signatures = [signature for chunk in signed for signature in chunk]
+        if amounts:
+            channel["highest"] = amounts[-1]
+        return [
+            {"channel_id": channel_id, "amount": str(drops), "public_key": channel["public_key"], "signature": signature}
+            for drops, signature in zip(amounts, signatures)
+        ]
+
+    def sign_batch(self, claims: Dict[str, int]) -> List[dict]:
+        """sign the next claim of many channels at once, {channel id: drops}"""
+        return [self.sign(channel_id, drops) for channel_id, drops in claims.items()]
+
+
+# endregion
+
+
 ### region GET
 
 async def online_verify_xrp_payment_channel_signature(url: str, channel_id: str, amount: Union[int, float, Decimal], public_key: str, signature: str) -> bool:
@@ -79,6 +177,21 @@ async def online_verify_xrp_payment_channel_signature(url: str, channel_id: str,
         value = result["signature_verified"]
     return value   
 
+def parse_payment_channel(paymentchannel: dict) -> dict:
+    paymentchannel_data = {}
+    paymentchannel_data["channel_id"] = paymentchannel["index"]
+    paymentchannel_data["sender"] = paymentchannel["Account"]
+    paymentchannel_data["amount_deposited"] = str(drops_to_xrp(paymentchannel["Amount"]))
+    paymentchannel_data["amount_paid_out"] = str(drops_to_xrp(paymentchannel["Balance"]))
+    paymentchannel_data["amount_remaining"] = str(drops_to_xrp(str(int(paymentchannel["Amount"]) - int(paymentchannel["Balance"]))))
+    paymentchannel_data["receiver"] = paymentchannel["Destination"]
+    paymentchannel_data["settle_delay"] = str(timedelta(seconds=(paymentchannel["SettleDelay"])))
+    paymentchannel_data["public_key"] = paymentchannel["PublicKey"]
+    paymentchannel_data["immutable_expiry_date"] = str(ripple_time_to_datetime(paymentchannel["CancelAfter"])) if "CancelAfter" in paymentchannel else ''
+    paymentchannel_data["expiry_date"] = str(ripple_time_to_datetime(paymentchannel["Expiration"])) if "Expiration" in paymentchannel else ''
+    paymentchannel_data["destination_tag"] = paymentchannel["DestinationTag"] if "DestinationTag" in paymentchannel else ''
+    return paymentchannel_data
+
 async def account_xrp_payment_channels(url: str, wallet_addr: str) -> list:
     """return a list of the payment channels created by an account"""
     paymentchannels_ = []
@@ -88,30 +201,154 @@ async def account_xrp_payment_channels(url: str, wallet_addr: str) -> list:
     if "account_objects" in result:
         account_paymentchannels = result["account_objects"]
         for paymentchannel in account_paymentchannels:
-            paymentchannel_data = {}
             #  condition to check if the amount is xrp
             if isinstance(paymentchannel["Amount"], str):
-                paymentchannel_data["channel_id"] = paymentchannel["index"]
-                paymentchannel_data["sender"] = paymentchannel["Account"]
-                paymentchannel_data["amount_deposited"] = str(drops_to_xrp(paymentchannel["Amount"]))
-                paymentchannel_data["amount_paid_out"] = str(drops_to_xrp(paymentchannel["Balance"]))
-                paymentchannel_data["amount_remaining"] = str(drops_to_xrp(str(int(paymentchannel["Amount"]) - int(paymentchannel["Balance"]))))
-                paymentchannel_data["receiver"] = paymentchannel["Destination"]
-                paymentchannel_data["settle_delay"] = str(timedelta(seconds=(paymentchannel["SettleDelay"])))
-                paymentchannel_data["public_key"] = paymentchannel["PublicKey"]
-                paymentchannel_data["immutable_expiry_date"] = str(ripple_time_to_datetime(paymentchannel["CancelAfter"])) if "CancelAfter" in paymentchannel else ''
-                paymentchannel_data["expiry_date"] = str(ripple_time_to_datetime(paymentchannel["Expiration"])) if "Expiration" in paymentchannel else ''
-                paymentchannel_data["destination_tag"] = paymentchannel["DestinationTag"] if "DestinationTag" in paymentchannel else ''
-                paymentchannels_.append(paymentchannel_data)
+                paymentchannels_.append(parse_payment_channel(paymentchannel))
     return paymentchannels_
 
-#TODO: complete me
 async def xrp_payment_channel_info(url:str, channel_id: str) -> dict:
-    pass
+    """return a payment channel's details, {} if it doesn't exist"""
+    req = LedgerEntry(payment_channel=channel_id, ledger_index="validated")
+    response =  await AsyncJsonRpcClient(url).request(req)
+    result = response.result
+    if "node" in result:
+        return parse_payment_channel(result["node"])
+    return {}
 
 
 # endregion
 
+
+# region STATE
+
+
+class ChannelStore:
+    """local copy of payment channels plus the highest claim accepted on each, so incoming claims are checked without rpc\n
+    channels are loaded once, then kept current from the validated transaction stream by `watch`;
+    `accept_claim` checks signature, order, coverage and expiry against that copy.
+    accepted claims go to `journal_path` if given, a restarted receiver keeps redeeming the highest one"""
+
+    def __init__(self, journal_path: str = None):
+        self.journal_path = journal_path
+        self.channels = {}
+        self.claims = load_journal(journal_path)  # channel id: highest accepted claim
+
+    def set_channel(self, channel_id: str, fields: dict, ledger_index: int = None) -> dict:
+        """store a PayChannel ledger object"""
+        channel = self.channels.setdefault(channel_id, {"channel_id": channel_id})
+        channel.update({
+            "sender": fields["Account"],
+            "receiver": fields["Destination"],
+            "public_key": fields["PublicKey"],
+            "amount": int(fields["Amount"]),
+            "balance": int(fields.get("Balance", 0)),
+            "settle_delay": fields["SettleDelay"],
+            "expiration": fields.get("Expiration"),
+            "cancel_after": fields.get("CancelAfter"),
+            "closed": False,
+            "ledger_index": ledger_index,
+        })
+        return channel
+
+    async def load(self, url: str, channel_id: str) -> dict:
+        """read one channel from the ledger"""
+        req = LedgerEntry(payment_channel=channel_id, ledger_index="validated")
+        response = await AsyncJsonRpcClient(url).request(req)
+        result = response.result
+        if "node" not in result:
+            raise ValueError(f"channel {channel_id} not found: {result.get('error', '')}")
+        return self.set_channel(channel_id, result["node"], result.get("ledger_index"))
+
+    async def load_account(self, url: str, wallet_addr: str) -> int:
+        """read every xrp channel an account sends or receives on, returns how many"""
+        client = AsyncJsonRpcClient(url)
+        count = 0
+        marker = None
+        while True:
+            req = AccountObjects(account=wallet_addr, type="payment_channel", ledger_index="validated", limit=400, marker=marker)
+            result = (await client.request(req)).result
+            for paymentchannel in result.get("account_objects", []):
+                if isinstance(paymentchannel["Amount"], str):
+                    self.set_channel(paymentchannel["index"], paymentchannel, result.get("ledger_index"))
+                    count += 1
+            marker = result.get("marker")
+            if marker is None:
+                return count
+
+    def apply_transaction(self, message: dict) -> list:
+        """update tracked channels from a validated transaction stream message, returns the channel ids it touched\n
+        works off the metadata so creates, funds, claims and closes are all handled the same way"""
+        touched = []
+        for node in message.get("meta", {}).get("AffectedNodes", []):
+            kind, entry = next(iter(node.items()))
+            if entry.get("LedgerEntryType") != "PayChannel":
+                continue
+            channel_id = entry["LedgerIndex"]
+            if kind == "DeletedNode":
+                if channel_id in self.channels:
+                    self.channels[channel_id]["closed"] = True
+                    touched.append(channel_id)
+            elif kind == "CreatedNode" or channel_id in self.channels:
+                fields = entry["NewFields"] if kind == "CreatedNode" else entry["FinalFields"]
+                if isinstance(fields.get("Amount"), str):
+                    self.set_channel(channel_id, fields, message.get("ledger_index"))
+                    touched.append(channel_id)
+        return touched
+
+    async def watch(self, ws_url: str, accounts: list = None) -> None:
+        """apply validated transactions of `accounts` (default the senders of tracked channels), runs until cancelled"""
+        accounts = accounts or sorted({channel["sender"] for channel in self.channels.values()})
+        async with AsyncWebsocketClient(ws_url) as client:
+            await client.request(Subscribe(accounts=accounts))
+            async for message in client:
+                if message.get("type") == "transaction" and message.get("validated"):
+                    self.apply_transaction(message)
+
+    def highest_claim(self, channel_id: str) -> dict:
+        """the highest claim accepted on a channel, {} if none"""
+        return self.claims.get(channel_id, {})
+
+    def check_claim(self, channel_id: str, drops: int, signature: str, now: int = None) -> str:
+        """why a claim can't be accepted, "" if it can; `now` in ripple time"""
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            return "unknown channel"
+        if channel["closed"]:
+            return "channel closed"
+        now = posix_to_ripple_time(int(time.time())) if now is None else now
+        for expiry in (channel["expiration"], channel["cancel_after"]):
+            if expiry is not None and expiry <= now:
+                return "channel expired"
+        if drops <= max(channel["balance"], int(self.highest_claim(channel_id).get("amount", 0))):
+            return "not above the highest claim"
+        if drops > channel["amount"]:
+            return "not covered by the channel"
+        if not verify_claim(channel_id, drops, channel["public_key"], signature):
+            return "invalid signature"
+        return ""
+
+    def accept_claim(self, channel_id: str, drops: int, signature: str, now: int = None) -> dict:
+        """check an incoming claim and keep it if it is valid, amount in drops\n
+        returns {accepted, reason, amount} where amount is the increase over the previous claim"""
+        drops = int(drops)
+        reason = self.check_claim(channel_id, drops, signature, now)
+        if reason:
+            return {"accepted": False, "reason": reason, "amount": "0"}
+        channel = self.channels[channel_id]
+        previous = max(channel["balance"], int(self.highest_claim(channel_id).get("amount", 0)))
+        claim = {"key": channel_id, "amount": str(drops), "signature": signature, "public_key": channel["public_key"]}
+        append_journal(self.journal_path, [claim])
+        self.claims[channel_id] = claim
+        return {"accepted": True, "reason": "", "amount": str(drops - previous)}
+
+    def unredeemed(self, channel_id: str) -> int:
+        """drops the highest accepted claim would still pay out if redeemed now"""
+        return max(int(self.highest_claim(channel_id).get("amount", 0)) - self.channels[channel_id]["balance"], 0)
+
+
+# endregion
+
+
 # from xrpl.wallet import Wallet
 # from xrpl.clients import JsonRpcClient
 # from xrpl.models import Transaction
@@ -1,8 +1,12 @@
+import asyncio
+from typing import Awaitable, Callable
 from xrpl.asyncio.clients import AsyncJsonRpcClient
 from xrpl.models import ( AccountSet, AccountObjects, TicketCreate,)
 from misc import mm
 from x_constants import M_SOURCE_TAG
 
+# an account can hold at most 250 tickets
+MAX_TICKETS = 250
 
 
 # region POST
@@ -25,20 +29,116 @@ def cancel_ticket(sender_addr: str, ticket_sequence: int, fee: str = None) -> di
 async def account_tickets(url: str, wallet_addr: str) -> list:
     """return a list tickets created by an account"""
     tickets_ = []
-    req = AccountObjects(account=wallet_addr, ledger_index="validated", type="ticket")
-    response =  await AsyncJsonRpcClient(url).request(req)
-    result = response.result
-    if "account_objects" in result:
-        account_tickets = result["account_objects"]
-        for ticket in account_tickets:
-            ticket_data = {}
-            ticket_data["ticket_id"] = ticket["index"]
-            ticket_data["account"] = ticket["Account"]
-            # ticket_data["flags"] = ticket["Flags"]
-            ticket_data["ticket_sequence"] = ticket["TicketSequence"]
-            tickets_.append(ticket_data)
+    marker = None
+    while True:
+        req = AccountObjects(account=wallet_addr, ledger_index="validated", type="ticket", limit=400, marker=marker)
+        response =  await AsyncJsonRpcClient(url).request(req)
+        result = response.result
+        if "account_objects" in result:
+            account_tickets = result["account_objects"]
+            for ticket in account_tickets:
+                ticket_data = {}
+                ticket_data["ticket_id"] = ticket["index"]
+                ticket_data["account"] = ticket["Account"]
+                # ticket_data["flags"] = ticket["Flags"]
+                ticket_data["ticket_sequence"] = ticket["TicketSequence"]
+                tickets_.append(ticket_data)
+        marker = result.get("marker")
+        if marker is None:
+            break
     return tickets_
 
+
+class TicketPool:
+    """lease an account's tickets to concurrent submitters so they don't contend on the account sequence\n
+    `submit` is a coroutine that signs, submits and waits for a TicketCreate transaction dict to validate;
+    the pool calls it to create `batch_size` more tickets whenever fewer than `low_watermark` are free"""
+
+    def __init__(self, url: str, account: str, submit: Callable[[dict], Awaitable], low_watermark: int = 25, batch_size: int = 100, fee: str = None):
+        self.url = url
+        self.account = account
+        self.submit = submit
+        self.low_watermark = low_watermark
+        self.batch_size = batch_size
+        self.fee = fee
+        self.free = []
+        self.leased = set()
+        self.used = set()  # released after use but maybe not yet validated
+        self._condition = asyncio.Condition()
+        self._replenishing = None
+        self._releases = 0
+        self._capped_at = None  # release count when the 250 cap last stopped a replenish
+
+    async def load(self) -> int:
+        """read the account's tickets from the ledger, returns how many are free"""
+        tickets = {ticket["ticket_sequence"] for ticket in await account_tickets(self.url, self.account)}
+        async with self._condition:
+            self.used &= tickets
+            self.free = sorted(tickets - self.leased - self.used, reverse=True)
+            self._condition.notify_all()
+        return len(self.free)
+
+    async def replenish(self) -> None:
+        """create tickets up to `batch_size`, without going over the 250 ticket cap"""
+        try:
+            # drops used tickets the ledger has consumed so they stop counting against the cap
+            await self.load()
+            count = min(self.batch_size, MAX_TICKETS - len(self.free) - len(self.leased) - len(self.used))
+            if count <= 0:
+                self._capped_at = self._releases
+                return
+            self._capped_at = None
+            await self.submit(create_ticket(self.account, count, fee=self.fee))
+            await self.load()
+        finally:
+            # wake waiting leases even if the submit failed so they can raise
+            async with self._condition:
+                self._condition.notify_all()
+
+    def _start_replenish(self) -> None:
+        # at the cap only a release can make room, don't ask the node again until one happens
+        if self._capped_at is not None and self._capped_at == self._releases:
+            return
+        if self._replenishing is None or self._replenishing.done():
+            self._replenishing = asyncio.ensure_future(self.replenish())
+
+    async def lease(self) -> int:
+        """take a free ticket sequence, waiting for new tickets if none are left"""
+        async with self._condition:
+            while not self.free:
+                self._start_replenish()
+                replenishing = self._replenishing
+                # woken by a finished replenish or a release
+                await self._condition.wait()
+                if replenishing is not None and replenishing.done() and replenishing.exception() is not None and not self.free:
+                    raise replenishing.exception()
+            ticket = self.free.pop()
+            self.leased.add(ticket)
+            if len(self.free) < self.low_watermark:
+                self._start_replenish()
+        return ticket
+
+    async def release(self, ticket: int, used: bool = True) -> None:
+        """return a leased ticket; `used` = a transaction with it reached the ledger, else it goes back to the free list"""
+        async with self._condition:
+            self.leased.discard(ticket)
+            self._releases += 1
+            if used:
+                self.used.add(ticket)
+            else:
+                self.free.append(ticket)
+                self.free.sort(reverse=True)
+            self._condition.notify_all()
+
+    async def fill(self, tx: dict, fee: str = None) -> dict:
+        """return a copy of a builder transaction set to use a leased ticket instead of the account sequence"""
+        tx = dict(tx)
+        tx["Sequence"] = 0
+        tx["TicketSequence"] = await self.lease()
+        if fee is not None and "Fee" not in tx:
+            tx["Fee"] = fee
+        return tx
+
 # uneccessary
 # async def get_ticket_info(url: str, ticket_id: str) -> dict:
 #     ticket_info = {}
@@ -1,3 +1,10 @@
+import asyncio
+import csv
+import heapq
+import math
+from decimal import Decimal
+from typing import AsyncIterator, Iterable, Iterator, Union
+
 from pydoc import cli
 from xrpl.models import (
     AccountInfo,
@@ -9,11 +16,15 @@ from xrpl.models import (
     AccountSetAsfFlag,
     TrustSetFlag,
     GatewayBalances,
-    Transaction,
     Clawback,
+    LedgerEntry,
+    MPTAmount,
 )
+from xrpl.models.requests.ledger_entry import MPToken
 from xrpl.asyncio.clients import AsyncJsonRpcClient
+from xrpl.wallet import Wallet
 from misc import (
+    gather_limited,
     mm,
     is_hex,
     transfer_fee_to_xrp_format,
@@ -22,6 +33,29 @@ from misc import (
     validate_hex_to_symbol,
 )
 from x_constants import M_SOURCE_TAG
+from transactions import (
+    AccountSequence,
+    SubmitTracker,
+    UNKNOWN_RESULTS,
+    append_journal,
+    journal_pending,
+    load_journal,
+    mpt_payment_template,
+    resolve_pending,
+    sign_transactions,
+    token_payment_template,
+)
+
+# MPToken / MPTokenIssuance ledger flags
+LSF_MPT_AUTHORIZED = 0x00000002
+LSF_MPT_REQUIRE_AUTH = 0x00000004
+
+# issuer AccountRoot ledger flags
+LSF_REQUIRE_AUTH = 0x00040000
+LSF_GLOBAL_FREEZE = 0x00400000
+
+# transactions rippled's queue holds per account while the open ledger fee is escalated
+TXQ_ACCOUNT_MAX = 10
 
 # region POST
 """4 step process to creating a token; must use 2 new accounts"""
@@ -328,20 +362,298 @@ async def account_tokens(url: str, wallet_addr: str) -> list:
 # endregion
 
 
-from xrpl.clients import JsonRpcClient
-from xrpl.transaction import submit_and_wait, sign_and_submit
+# region DISTRIBUTE
 
-client = JsonRpcClient("https://s.altnet.rippletest.net:51234/")
 
-from xrpl.wallet import Wallet, generate_faucet_wallet
+def read_recipients(recipients: Union[str, Iterable]) -> Iterator[tuple]:
+    """yield (address, amount) from a csv file of `address,amount` rows (a header row is skipped) or from an iterable of pairs"""
+    if isinstance(recipients, str):
+        with open(recipients, newline="") as source:
+            for row in csv.reader(source):
+                if len(row) >= 2 and row[0].strip().startswith("r"):
+                    yield row[0].strip(), row[1].strip()
+    else:
+        for address, amount in recipients:
+            yield address, str(amount)
 
-m = Wallet.from_seed(seed="sEdTYgXS4mDuZq1DD5iiQgq11TQCjAz")
 
-for i in range(100):
-    w = generate_faucet_wallet(client=client)
-    sign_and_submit(
-        transaction=Transaction.from_xrpl(add_token(m.address, "USD", w.address)),
-        client=client,
-        wallet=m,
-    )
-    print(f"done {i}")
+async def trustline_ready(url: str, wallet_addr: str, token: str, issuer: str, amount: str, require_auth: bool = None) -> bool:
+    """check the account has an authorized, unfrozen trustline to `issuer` with room for `amount`\n
+    account_lines only lists `peer_authorized` when it is set, so whether the issuer has RequireAuth is read with `issuer_flags`
+    unless `require_auth` is passed"""
+    req = AccountLines(account=wallet_addr, peer=issuer, ledger_index="validated")
+    response = await AsyncJsonRpcClient(url).request(req)
+    result = response.result
+    currency = validate_symbol_to_hex(token)
+    for line in result.get("lines", []):
+        if line["currency"] == currency:
+            if line.get("freeze_peer", False) or line.get("freeze", False):
+                return False
+            if require_auth is None:
+                require_auth = await issuer_flags(url, issuer) & LSF_REQUIRE_AUTH == LSF_REQUIRE_AUTH
+            if require_auth and line.get("peer_authorized") is not True:
+                return False
+            return float(line["limit"]) - float(line["balance"]) >= float(amount)
+    return False
+
+
+async def mpt_ready(url: str, wallet_addr: str, mpt_issuance_id: str, require_auth: bool = False) -> bool:
+    """check the account holds the mpt (has opted in) and, if the issuance requires it, is authorized"""
+    req = LedgerEntry(ledger_index="validated", mptoken=MPToken(mpt_issuance_id=mpt_issuance_id, account=wallet_addr))
+    response = await AsyncJsonRpcClient(url).request(req)
+    result = response.result
+    if "node" not in result:
+        return False
+    return not require_auth or result["node"].get("Flags", 0) & LSF_MPT_AUTHORIZED == LSF_MPT_AUTHORIZED
+
+
+async def issuer_flags(url: str, issuer: str) -> int:
+    """the Flags of the issuer's AccountRoot, see LSF_REQUIRE_AUTH and LSF_GLOBAL_FREEZE"""
+    req = AccountInfo(account=issuer, ledger_index="validated")
+    response = await AsyncJsonRpcClient(url).request(req)
+    result = response.result
+    if "account_data" not in result:
+        raise ValueError(f"account_info failed for {issuer}: {result.get('error', '')}")
+    return result["account_data"].get("Flags", 0)
+
+
+async def mpt_requires_auth(url: str, mpt_issuance_id: str) -> bool:
+    req = LedgerEntry(ledger_index="validated", mpt_issuance=mpt_issuance_id)
+    response = await AsyncJsonRpcClient(url).request(req)
+    result = response.result
+    return "node" in result and result["node"].get("Flags", 0) & LSF_MPT_REQUIRE_AUTH == LSF_MPT_REQUIRE_AUTH
+
+
+async def distribute_tokens(
+    url: str,
+    ws_url: str,
+    sender: Wallet,
+    recipients: Union[str, Iterable],
+    token: str = None,
+    issuer: str = None,
+    mpt_issuance_id: str = None,
+    journal_path: str = None,
+    concurrency: int = 20,
+    batch_size: int = 500,
+    fee: str = "12",
+    resubmits: int = 2,
+    max_in_flight: int = TXQ_ACCOUNT_MAX,
+) -> dict:
+    """send an issued token (`token` + `issuer`) or an mpt (`mpt_issuance_id`) to many recipients\n
+    recipients is a csv path or iterable of (address, amount). per batch the recipients' trustline/mpt state is checked
+    `concurrency` at a time, ready ones are paid from local sequences, signed in a process pool and tracked on the ledger stream;
+    every payment is journaled as pending before it is submitted and again with its outcome, so a rerun with the same
+    journal first settles what was in flight (looked up, or waited out past its LastLedgerSequence) and skips recipients already paid.
+    payments that expired or hit tefPAST_SEQ are sent again under a resynced sequence up to `resubmits` times.
+    at most `max_in_flight` payments are submitted before their outcomes are in, once the open ledger escalates the node
+    queues no more than TXQ_ACCOUNT_MAX per account and later sequences would only stall behind the rejected ones\n
+    returns counts per result"""
+    journal = load_journal(journal_path)
+    pending = {key: record for key, record in journal.items() if record["result"] == "pending"}
+    if pending:
+        # payments submitted by a run that stopped before recording their outcome
+        settled = [dict(pending[key], result=outcome["result"]) for key, outcome in (await resolve_pending(url, pending)).items()]
+        append_journal(journal_path, settled)
+        journal.update({record["key"]: record for record in settled})
+    require_auth = False
+    global_freeze = False
+    if mpt_issuance_id is not None:
+        template = mpt_payment_template(sender.address, mpt_issuance_id, fee=fee)
+        require_auth = await mpt_requires_auth(url, mpt_issuance_id)
+    else:
+        template = token_payment_template(sender.address, token, issuer, fee=fee)
+        flags = await issuer_flags(url, issuer)
+        require_auth = flags & LSF_REQUIRE_AUTH == LSF_REQUIRE_AUTH
+        global_freeze = flags & LSF_GLOBAL_FREEZE == LSF_GLOBAL_FREEZE
+    sequence = AccountSequence(url, sender.address)
+    summary = {}
+
+    async def pay(rows: list) -> list:
+        """submit payments for (key, address, amount) rows, returns their journal records"""
+        records = []
+        for attempt in range(resubmits + 1):
+            txs = []
+            for _, address, amount in rows:
+                value = MPTAmount(mpt_issuance_id=mpt_issuance_id, value=amount) if mpt_issuance_id is not None else IssuedCurrencyAmount(currency=validate_symbol_to_hex(token), issuer=issuer, value=amount)
+                txs.append(await sequence.fill(template.build(destination=address, amount=value)))
+            signed = await asyncio.to_thread(sign_transactions, txs, sender)
+            # the estimate runs ahead when ledgers close slowly, step back so the lookup window can't miss the transaction
+            ledger_index = sequence.ledger_index() - sequence.ledger_offset
+            pending = [journal_pending({"key": key, "address": address, "amount": amount}, tx, ledger_index) for (key, address, amount), tx in zip(rows, signed)]
+            append_journal(journal_path, pending)
+            outcomes = await tracker.submit_many(signed)
+            unknown = {record["key"]: record for record, outcome in zip(pending, outcomes) if outcome["result"] in UNKNOWN_RESULTS}
+            if unknown:
+                resolved = await resolve_pending(url, unknown)
+                outcomes = [resolved.get(record["key"], outcome) for record, outcome in zip(pending, outcomes)]
+            retry = []
+            for row, record, outcome in zip(rows, pending, outcomes):
+                # every outcome is final here, so the allocator can take back sequences that went unused
+                if await sequence.handle_result(outcome["result"], record["sequence"]) and attempt < resubmits:
+                    retry.append(row)
+                else:
+                    records.append(dict(record, result=outcome["result"]))
+            if not retry:
+                break
+            rows = retry
+        return records
+
+    async def send_batch(batch: list) -> None:
+        if mpt_issuance_id is not None:
+            ready = await gather_limited([mpt_ready(url, address, mpt_issuance_id, require_auth) for _, address, _ in batch], concurrency)
+        elif global_freeze:
+            # no trustline of a globally frozen issuer can receive its tokens
+            ready = [False] * len(batch)
+        else:
+            ready = await gather_limited([trustline_ready(url, address, token, issuer, amount, require_auth) for _, address, amount in batch], concurrency)
+        records = []
+        rows = []
+        for row, is_ready in zip(batch, ready):
+            if is_ready:
+                rows.append(row)
+            else:
+                records.append({"key": row[0], "address": row[1], "amount": row[2], "hash": "", "result": "not_ready"})
+        for start in range(0, len(rows), max_in_flight):
+            records.extend(await pay(rows[start:start + max_in_flight]))
+        append_journal(journal_path, records)
+        for record in records:
+            summary[record["result"]] = summary.get(record["result"], 0) + 1
+
+    async with SubmitTracker(ws_url, on_ledger=sequence.set_ledger_index) as tracker:
+        batch = []
+        for index, (address, amount) in enumerate(read_recipients(recipients)):
+            key = f"{index}:{address}"
+            if key in journal and journal[key]["result"] == "tesSUCCESS":
+                summary["already_paid"] = summary.get("already_paid", 0) + 1
+                continue
+            batch.append((key, address, amount))
+            if len(batch) >= batch_size:
+                await send_batch(batch)
+                batch = []
+        if batch:
+            await send_batch(batch)
+    return summary
+
+
+# endregion
+
+
+# region HOLDERS
+
+
+async def stream_token_holders(url: str, issuer: str, token: str = None, include_zero: bool = False, page_size: int = 400) -> AsyncIterator[dict]:
+    """yield the holders of an issuer's tokens page by page from its trust lines, without keeping them\n
+    every page is read from the ledger of the first so the scan is a consistent snapshot.
+    records: holder, token, balance (what the holder owns), limit, frozen, ledger_index"""
+    client = AsyncJsonRpcClient(url)
+    currency = validate_symbol_to_hex(token) if token else None
+    ledger_index = "validated"
+    marker = None
+    while True:
+        req = AccountLines(account=issuer, ledger_index=ledger_index, limit=page_size, marker=marker)
+        result = (await client.request(req)).result
+        if "lines" not in result:
+            raise ValueError(f"account_lines failed: {result.get('error', '')}")
+        ledger_index = result.get("ledger_index", ledger_index)
+        for line in result["lines"]:
+            if currency is not None and line["currency"] != currency:
+                continue
+            # lines are seen from the issuer's side, a holder's tokens are a negative balance
+            balance = -Decimal(line["balance"])
+            if balance <= 0 and not include_zero:
+                continue
+            yield {
+                "holder": line["account"],
+                "token": validate_hex_to_symbol(line["currency"]),
+                "balance": balance,
+                "limit": line["limit_peer"],
+                "frozen": line.get("freeze", False),
+                "ledger_index": ledger_index,
+            }
+        marker = result.get("marker")
+        if marker is None:
+            return
+
+
+class HolderStats:
+    """distribution of holder balances computed one holder at a time\n
+    keeps count, total, mean and standard deviation (welford), the `top` largest holders in a heap
+    and a histogram by order of magnitude, so memory doesn't grow with the number of holders"""
+
+    def __init__(self, top: int = 100):
+        self.top = top
+        self.count = 0
+        self.total = Decimal(0)
+        self.smallest = None
+        self.buckets = {}  # power of ten: holders with a balance of that magnitude
+        self._top = []  # min heap of (balance, holder)
+        self._mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, holder: str, balance: Decimal) -> None:
+        self.count += 1
+        self.total += balance
+        self.smallest = balance if self.smallest is None else min(self.smallest, balance)
+        value = float(balance)
+        delta = value - self._mean
+        self._mean += delta / self.count
+        self._m2 += delta * (value - self._mean)
+        magnitude = balance.adjusted() if balance > 0 else None
+        self.buckets[magnitude] = self.buckets.get(magnitude, 0) + 1
+        if len(self._top) < self.top:
+            heapq.heappush(self._top, (balance, holder))
+        elif balance > self._top[0][0]:
+            heapq.heapreplace(self._top, (balance, holder))
+
+    def top_holders(self) -> list:
+        return [{"holder": holder, "balance": str(balance)} for balance, holder in sorted(self._top, reverse=True)]
+
+    def result(self) -> dict:
+        top_total = sum((balance for balance, _ in self._top), Decimal(0))
+        return {
+            "holders": self.count,
+            "total": str(self.total),
+            "mean": str(self._mean),
+            "stddev": str(math.sqrt(self._m2 / self.count)) if self.count else "0",
+            "smallest": str(self.smallest) if self.smallest is not None else "0",
+            "largest": str(max(self._top)[0]) if self._top else "0",
+            "top_share": str(top_total / self.total) if self.total else "0",
+            "top_holders": self.top_holders(),
+            "distribution": [
+                {"from": "0" if magnitude is None else str(Decimal(10) ** magnitude), "holders": count}
+                for magnitude, count in sorted(self.buckets.items(), key=lambda bucket: -math.inf if bucket[0] is None else bucket[0])
+            ],
+        }
+
+
+async def scan_token_holders(
+    url: str,
+    issuer: str,
+    token: str,
+    top: int = 100,
+    snapshot_path: str = None,
+    include_zero: bool = False,
+) -> dict:
+    """holder statistics of one token, see HolderStats; `snapshot_path` also writes every holder to a csv
+    (`address,amount`, readable by `read_recipients`) as the scan goes, for airdrops"""
+    stats = HolderStats(top)
+    ledger_index = None
+    snapshot = open(snapshot_path, "w", newline="") if snapshot_path else None
+    try:
+        writer = csv.writer(snapshot) if snapshot else None
+        if writer:
+            writer.writerow(["address", "amount"])
+        async for holder in stream_token_holders(url, issuer, token, include_zero):
+            ledger_index = holder["ledger_index"]
+            stats.add(holder["holder"], holder["balance"])
+            if writer:
+                writer.writerow([holder["holder"], str(holder["balance"])])
+    finally:
+        if snapshot:
+            snapshot.close()
+    result = stats.result()
+    result.update({"token": token, "issuer": issuer, "ledger_index": ledger_index})
+    return result
+
+
+# endregion
@@ -0,0 +1,622 @@
+import asyncio
+import heapq
+import json
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256, sha512
+from typing import Callable, Dict, Iterable, Iterator, List, Union
+
+from xrpl.asyncio.clients import AsyncJsonRpcClient, AsyncWebsocketClient
+from xrpl.core.addresscodec import is_valid_classic_address
+from xrpl.core.binarycodec import encode, encode_for_signing
+from xrpl.core.keypairs import sign
+from xrpl.models import AccountInfo, Fee, Ledger, ServerState, StreamParameter, Subscribe, SubmitOnly, Transaction, Tx
+from xrpl.models.base_model import BaseModel
+from xrpl.models.transactions.transaction import transaction_json_to_binary_codec_form
+from xrpl import CryptoAlgorithm
+from xrpl.wallet import Wallet
+
+from wallets import send_mpt_token, send_token, send_xrp
+
+
+# helpers to move many transactions built in this repo from dicts to the ledger
+# https://xrpl.org/docs/concepts/transactions/secure-signing
+
+# prefix rippled hashes signed transactions with, "TXN\0"
+TXN_HASH_PREFIX = "54584E00"
+
+# ledgers close every 3-4 seconds, the slower figure keeps LastLedgerSequence estimates on the safe side
+LEDGER_SECONDS = 4
+
+# final results of a transaction that never applied and is safe to send again under a fresh sequence;
+# terPRE_SEQ is not one of them, rippled holds the transaction and it can still apply until it expires
+SEQUENCE_RESYNC_RESULTS = ("tefPAST_SEQ", "expired")
+
+# results that don't free the sequence: applied (tes, tec) or still waiting in the node (ter)
+SEQUENCE_USED_PREFIXES = ("tes", "tec", "ter")
+
+# stands in for the destination while a template is validated, ACCOUNT_ONE
+TEMPLATE_DESTINATION = "rrrrrrrrrrrrrrrrrrrrBZbvji"
+
+# preliminary results that mean the transaction can never make it into a ledger
+# https://xrpl.org/docs/references/protocol/transactions/transaction-results
+FINAL_FAILURE_PREFIXES = ("tem", "tef", "tel")
+
+# tracker results that say nothing about whether the transaction applied, it has to be looked up
+UNKNOWN_RESULTS = ("tracker closed", "connection closed")
+
+# widest min_ledger..max_ledger range `tx` accepts
+MAX_TX_LEDGER_RANGE = 1000
+
+# fee level of a transaction paying exactly the reference fee
+# https://xrpl.org/docs/concepts/transactions/transaction-cost#fee-levels
+REFERENCE_FEE_LEVEL = 256
+
+# how much ahead of the open ledger each urgency bids, as extra transactions assumed to arrive before ours
+FEE_URGENCY = {"low": None, "normal": 0, "high": 0.2}
+
+
+# region SIGN
+
+
+def sign_transaction(tx: dict, public_key: str, private_key: str) -> dict:
+    """sign a transaction dict from any of the builders, offline\n
+    the dict must already hold Sequence (or TicketSequence), Fee and LastLedgerSequence"""
+    tx = dict(tx)
+    tx["SigningPubKey"] = public_key
+    tx["TxnSignature"] = sign(bytes.fromhex(encode_for_signing(tx)), private_key)
+    tx_blob = encode(tx)
+    return {
+        "tx_blob": tx_blob,
+        "hash": sha512(bytes.fromhex(TXN_HASH_PREFIX + tx_blob)).hexdigest().upper()[:64],
+        "account": tx["Account"],
+        "sequence": tx["TicketSequence"] if "TicketSequence" in tx else tx["Sequence"],
+        "last_ledger_sequence": tx["LastLedgerSequence"] if "LastLedgerSequence" in tx else None,
+    }
+
+
+class Keyring:
+    """derive each seed's keys once and keep them in memory for `ttl` seconds\n
+    Wallet.from_seed costs a key derivation every call, secp256k1 seeds especially;
+    the keyring hands out the cached keys and can sign for its accounts directly through `sign_transactions`\n
+    private keys are held in bytearrays that are overwritten when they expire or are removed.
+    python copies a key into an immutable str for every signature, so this narrows how long keys sit in memory, it can't guarantee it"""
+
+    def __init__(self, ttl: float = 900, max_entries: int = 1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._keys = {}  # address: [public key, private key bytearray, expires]
+        self._seeds = {}  # sha256 of seed: address
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        self.purge()
+        return len(self._keys)
+
+    def __contains__(self, address: str) -> bool:
+        return self._entry(address) is not None
+
+    def _entry(self, address: str) -> list:
+        with self._lock:
+            entry = self._keys.get(address)
+            if entry is not None and entry[2] <= time.monotonic():
+                self._remove(address)
+                return None
+            return entry
+
+    def _remove(self, address: str) -> None:
+        entry = self._keys.pop(address, None)
+        if entry is not None:
+            entry[1][:] = bytes(len(entry[1]))
+        for digest in [digest for digest, addr in self._seeds.items() if addr == address]:
+            del self._seeds[digest]
+
+    def add(self, seed: str, algorithm: CryptoAlgorithm = None) -> str:
+        """derive a seed's keys unless they are already held, returns its address"""
+        digest = sha256(f"{seed}:{algorithm}".encode()).digest()
+        with self._lock:
+            address = self._seeds.get(digest)
+            if address is not None and self._keys[address][2] > time.monotonic():
+                return address
+        wallet = Wallet.from_seed(seed, algorithm=algorithm) if algorithm else Wallet.from_seed(seed)
+        with self._lock:
+            if wallet.address not in self._keys and len(self._keys) >= self.max_entries:
+                # drop the oldest added account
+                self._remove(next(iter(self._keys)))
+            self._remove(wallet.address)
+            self._keys[wallet.address] = [wallet.public_key, bytearray(wallet.private_key.encode()), time.monotonic() + self.ttl]
+            self._seeds[digest] = wallet.address
+        return wallet.address
+
+    def keys(self, address: str) -> tuple:
+        """return (public key, private key) of a held account"""
+        entry = self._entry(address)
+        if entry is None:
+            raise KeyError(f"no keys held for {address}")
+        return entry[0], entry[1].decode()
+
+    def wallet(self, seed: str, algorithm: CryptoAlgorithm = None) -> Wallet:
+        """drop-in for Wallet.from_seed that only derives the keys the first time"""
+        address = self.add(seed, algorithm)
+        return Wallet(*self.keys(address))
+
+    def remove(self, address: str) -> None:
+        """forget an account and wipe its private key"""
+        with self._lock:
+            self._remove(address)
+
+    def purge(self) -> int:
+        """wipe every expired key, returns how many were dropped"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [address for address, entry in self._keys.items() if entry[2] <= now]
+            for address in expired:
+                self._remove(address)
+        return len(expired)
+
+    def clear(self) -> None:
+        with self._lock:
+            for address in list(self._keys):
+                self._remove(address)
+
+
+def sign_transactions(
+    transactions: List[dict],
+    wallets: Union[Wallet, List[Wallet], Dict[str, Wallet], Keyring],
+    workers: int = None,
+    chunksize: int = 256,
+) -> List[dict]:
+    """sign many transaction dicts across a process pool, results keep the input order\n
+    each transaction is signed by the wallet, or the keyring account, whose address is its `Account`\n
+    batches no bigger than `chunksize` are signed in this process since starting a pool costs more than it saves"""
+    if isinstance(wallets, Wallet):
+        wallets = [wallets]
+    if isinstance(wallets, Keyring):
+        keys = {}
+        for tx in transactions:
+            if tx["Account"] not in keys:
+                if tx["Account"] not in wallets:
+                    raise ValueError(f"no wallet to sign for {tx['Account']}")
+                keys[tx["Account"]] = wallets.keys(tx["Account"])
+    else:
+        if not isinstance(wallets, dict):
+            wallets = {wallet.address: wallet for wallet in wallets}
+        keys = {}
+        for tx in transactions:
+            if tx["Account"] not in wallets:
+                raise ValueError(f"no wallet to sign for {tx['Account']}")
+            keys[tx["Account"]] = (wallets[tx["Account"]].public_key, wallets[tx["Account"]].private_key)
+    public_keys = [keys[tx["Account"]][0] for tx in transactions]
+    private_keys = [keys[tx["Account"]][1] for tx in transactions]
+    if len(transactions) <= chunksize:
+        return list(map(sign_transaction, transactions, public_keys, private_keys))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(sign_transaction, transactions, public_keys, private_keys, chunksize=chunksize))
+
+
+# endregion
+
+
+# region TEMPLATE
+
+
+class TransactionTemplate:
+    """a builder transaction validated once and then copied with only its varying fields replaced\n
+    `build` takes fields in builder (snake_case) form, already in ledger units e.g amount=xrp_to_drops(5);
+    `linked` copies a field to others on every build, like Amount to SendMax for token payments"""
+
+    def __init__(self, tx: dict, linked: Dict[str, List[str]] = None):
+        Transaction.from_xrpl(tx)  # raises if the model is invalid
+        self.tx = tx
+        self.linked = linked or {}
+
+    def build(self, **fields) -> dict:
+        tx = dict(self.tx)
+        tx.update(transaction_json_to_binary_codec_form(
+            {key: value.to_dict() if isinstance(value, BaseModel) else value for key, value in fields.items()}
+        ))
+        for field, targets in self.linked.items():
+            for target in targets:
+                tx[target] = tx[field]
+        if "Destination" in tx and not is_valid_classic_address(tx["Destination"]):
+            raise ValueError(f"invalid destination {tx['Destination']}")
+        return tx
+
+    def build_many(self, rows: Iterable[dict]) -> Iterator[dict]:
+        """build one transaction per dict of varying fields"""
+        for row in rows:
+            yield self.build(**row)
+
+
+def xrp_payment_template(sender_addr: str, fee: str = None, note: str = None) -> TransactionTemplate:
+    """`send_xrp` template, build with destination, amount (drops) and optionally sequence, destination_tag"""
+    return TransactionTemplate(send_xrp(sender_addr, TEMPLATE_DESTINATION, 1, note=note, fee=fee))
+
+
+def token_payment_template(sender_addr: str, token: str, issuer: str, fee: str = None, note: str = None) -> TransactionTemplate:
+    """`send_token` template, build with destination, amount (IssuedCurrencyAmount) and optionally sequence, destination_tag"""
+    return TransactionTemplate(send_token(sender_addr, TEMPLATE_DESTINATION, token, "1", issuer, note=note, fee=fee), linked={"Amount": ["SendMax"]})
+
+
+def mpt_payment_template(sender_addr: str, mpt_issuance_id: str, fee: str = None) -> TransactionTemplate:
+    """`send_mpt_token` template, build with destination, amount (MPTAmount) and optionally sequence"""
+    return TransactionTemplate(send_mpt_token(sender_addr, mpt_issuance_id, "1", TEMPLATE_DESTINATION, fee=fee), linked={"Amount": ["SendMax"]})
+
+
+# endregion
+
+
+# region SEQUENCE
+
+
+class AccountSequence:
+    """hand out consecutive sequences for one account locally instead of an account_info call per transaction\n
+    `sync` reads the account once, every `fill` after that is local.
+    submitters report final results to `handle_result` so the allocator resyncs when a sequence went unused"""
+
+    def __init__(self, url: str, account: str, ledger_offset: int = 20):
+        self.url = url
+        self.account = account
+        self.ledger_offset = ledger_offset
+        self.synced_sequence = None
+        self._next_sequence = None
+        self._ledger_index = None
+        self._ledger_time = None
+        self._lock = asyncio.Lock()
+
+    async def sync(self) -> int:
+        """read the account sequence and current ledger from the node, returns the next sequence"""
+        req = AccountInfo(account=self.account, ledger_index="current")
+        response = await AsyncJsonRpcClient(self.url).request(req)
+        result = response.result
+        if "account_data" not in result:
+            raise ValueError(f"account {self.account} not found: {result.get('error', '')}")
+        self.synced_sequence = result["account_data"]["Sequence"]
+        self._next_sequence = self.synced_sequence
+        self.set_ledger_index(result["ledger_current_index"])
+        return self._next_sequence
+
+    def set_ledger_index(self, ledger_index: int) -> None:
+        """record the latest ledger index, e.g from a ledger stream, so LastLedgerSequence needs no request"""
+        self._ledger_index = ledger_index
+        self._ledger_time = time.monotonic()
+
+    def ledger_index(self) -> int:
+        """estimate of the current ledger index from the last known one and the time since"""
+        return self._ledger_index + int((time.monotonic() - self._ledger_time) / LEDGER_SECONDS)
+
+    async def next(self) -> dict:
+        """allocate the next sequence, returned with its LastLedgerSequence"""
+        async with self._lock:
+            if self._next_sequence is None:
+                await self.sync()
+            sequence = self._next_sequence
+            self._next_sequence += 1
+        return {"Sequence": sequence, "LastLedgerSequence": self.ledger_index() + self.ledger_offset}
+
+    async def fill(self, tx: dict, fee: str = None) -> dict:
+        """return a copy of a builder transaction with Sequence, LastLedgerSequence and, if missing, Fee set"""
+        tx = dict(tx)
+        tx.update(await self.next())
+        if fee is not None and "Fee" not in tx:
+            tx["Fee"] = fee
+        return tx
+
+    async def fill_many(self, transactions: List[dict], fee: str = None) -> List[dict]:
+        """fill transactions with consecutive sequences in input order"""
+        return [await self.fill(tx, fee) for tx in transactions]
+
+    async def handle_result(self, result: str, sequence: int) -> bool:
+        """report the final result of a transaction that used `sequence`, e.g. a SubmitTracker outcome's `result`,
+        once nothing after it is in flight\n
+        a transaction that didn't apply left its sequence unused, so the allocator resyncs;
+        returns True for tefPAST_SEQ and "expired", the transaction then has to be filled, signed and submitted again"""
+        if result.startswith(SEQUENCE_USED_PREFIXES):
+            return False
+        async with self._lock:
+            # nothing to do when the allocator hands this sequence out again anyway, e.g. after an earlier resync
+            if self._next_sequence is None or sequence < self._next_sequence:
+                await self.sync()
+        return result in SEQUENCE_RESYNC_RESULTS
+
+
+# endregion
+
+
+# region FEE
+
+
+class FeeOracle:
+    """keep the node's fee and load state per ledger so a fee can be picked without asking the node every transaction\n
+    `refresh` reads `fee` and `server_state` once, `start` repeats it every ledger in the background
+    (or pass `on_ledger` to a SubmitTracker); `recommend` then answers from the cached state\n
+    urgency: low = lowest fee the queue accepts, the transaction may wait a few ledgers;
+    normal = enough for the current open ledger; high = open ledger fee with room for the ledger to keep filling"""
+
+    def __init__(self, url: str, max_fee: int = 10_000):
+        self.url = url
+        self.max_fee = max_fee
+        self.state = None
+        self.updated = None
+        self._refreshing = None
+        self._poller = None
+
+    async def refresh(self) -> dict:
+        """read fee levels and server load from the node"""
+        client = AsyncJsonRpcClient(self.url)
+        fee, server = await asyncio.gather(client.request(Fee()), client.request(ServerState()))
+        if not fee.is_successful() or not server.is_successful():
+            raise ValueError(f"fee request failed: {fee.result.get('error', '')} {server.result.get('error', '')}")
+        server_state = server.result["state"]
+        self.state = {
+            "ledger_index": int(fee.result["ledger_current_index"]),
+            "base_fee": int(fee.result["drops"]["base_fee"]),
+            "minimum_fee": int(fee.result["drops"]["minimum_fee"]),
+            "open_ledger_fee": int(fee.result["drops"]["open_ledger_fee"]),
+            "median_level": int(fee.result["levels"]["median_level"]),
+            "current_ledger_size": int(fee.result["current_ledger_size"]),
+            "expected_ledger_size": int(fee.result["expected_ledger_size"]),
+            "queue_size": int(fee.result["current_queue_size"]),
+            "max_queue_size": int(fee.result.get("max_queue_size", 0)),
+            "load_factor": server_state["load_factor"] / server_state.get("load_base", REFERENCE_FEE_LEVEL),
+        }
+        self.updated = time.monotonic()
+        return self.state
+
+    def on_ledger(self, ledger_index: int) -> None:
+        """ledger stream hook, refreshes in the background once per new ledger"""
+        if self.state is not None and ledger_index < self.state["ledger_index"]:
+            return
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.ensure_future(self.refresh())
+
+    async def _poll(self) -> None:
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                pass  # keep the last good state, the next ledger may answer
+            await asyncio.sleep(LEDGER_SECONDS)
+
+    async def start(self) -> dict:
+        """refresh now, then every ledger until `stop`"""
+        state = await self.refresh()
+        self._poller = asyncio.ensure_future(self._poll())
+        return state
+
+    async def stop(self) -> None:
+        if self._poller is not None:
+            self._poller.cancel()
+            self._poller = None
+
+    def age(self) -> float:
+        """seconds since the state was read, None before the first refresh"""
+        return None if self.updated is None else time.monotonic() - self.updated
+
+    def escalated_fee(self, extra: float = 0) -> int:
+        """open ledger fee, in drops, once the open ledger holds `extra` (fraction of expected) more transactions\n
+        past the expected size the required fee level grows with the square of the open ledger's size"""
+        state = self.state
+        expected = max(state["expected_ledger_size"], 1)
+        size = state["current_ledger_size"] + expected * extra
+        if size <= expected:
+            return state["open_ledger_fee"]
+        level = state["median_level"] * size * size / (expected * expected)
+        return max(state["open_ledger_fee"], int(level * state["base_fee"] / REFERENCE_FEE_LEVEL) + 1)
+
+    def recommend(self, urgency: str = "normal") -> str:
+        """fee in drops for `urgency` from the cached state, no network call"""
+        if self.state is None:
+            raise ValueError("no fee state yet, call refresh or start first")
+        if urgency not in FEE_URGENCY:
+            raise ValueError(f"urgency must be one of {list(FEE_URGENCY)}")
+        state = self.state
+        # a loaded server charges more than the reference fee for everything
+        floor = int(state["base_fee"] * max(state["load_factor"], 1))
+        if FEE_URGENCY[urgency] is None:
+            fee = state["minimum_fee"]
+        else:
+            fee = self.escalated_fee(FEE_URGENCY[urgency])
+        return str(min(max(fee, floor), self.max_fee))
+
+    async def fee(self, urgency: str = "normal", max_age: float = LEDGER_SECONDS * 2) -> str:
+        """`recommend`, refreshing first only if the cached state is older than `max_age` seconds"""
+        if self.state is None or self.age() > max_age:
+            await self.refresh()
+        return self.recommend(urgency)
+
+
+# endregion
+
+
+# region SUBMIT
+
+
+class SubmitTracker:
+    """submit signed transactions over one websocket and learn their outcome from the validated stream\n
+    instead of polling `tx` for every hash, the tracker subscribes to the ledger stream and the submitting accounts;
+    each `submit` returns a future that resolves when the hash shows up validated or its LastLedgerSequence has passed\n
+    futures resolve to a dict: hash, engine_result (preliminary), result (final), validated, ledger_index, meta"""
+
+    def __init__(self, ws_url: str, on_ledger: Callable[[int], None] = None):
+        self.ws_url = ws_url
+        self.on_ledger = on_ledger
+        self.ledger_index = None
+        self.pending = {}
+        self.client = None
+        self._accounts = set()
+        self._expiry = []  # heap of (last_ledger_sequence, hash)
+        self._listener = None
+
+    async def open(self) -> None:
+        self.client = AsyncWebsocketClient(self.ws_url)
+        await self.client.open()
+        response = await self.client.request(Subscribe(streams=[StreamParameter.LEDGER]))
+        if "ledger_index" in response.result:
+            self._ledger_closed(response.result["ledger_index"])
+        self._listener = asyncio.ensure_future(self._listen())
+
+    async def close(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+        if self.client is not None:
+            await self.client.close()
+        self._fail_pending("tracker closed")
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.close()
+
+    def _resolve(self, tx_hash: str, outcome: dict) -> None:
+        entry = self.pending.pop(tx_hash, None)
+        if entry is not None and not entry["future"].done():
+            entry["outcome"].update(outcome)
+            entry["future"].set_result(entry["outcome"])
+
+    def _fail_pending(self, reason: str) -> None:
+        for tx_hash in list(self.pending):
+            self._resolve(tx_hash, {"result": reason, "validated": False})
+
+    def _ledger_closed(self, ledger_index: int) -> None:
+        self.ledger_index = ledger_index
+        if self.on_ledger is not None:
+            self.on_ledger(ledger_index)
+        # rippled publishes ledgerClosed n before the transactions of ledger n, so a transaction with LastLedgerSequence n
+        # may still show up after this message; only once ledgerClosed n + 1 arrives have all of ledger n's transactions
+        # been seen. keep the comparison strict, `<=` would expire transactions that validated in ledger n
+        while self._expiry and self._expiry[0][0] < ledger_index:
+            _, tx_hash = heapq.heappop(self._expiry)
+            self._resolve(tx_hash, {"result": "expired", "validated": False, "ledger_index": ledger_index})
+
+    async def _listen(self) -> None:
+        try:
+            async for message in self.client:
+                if message.get("type") == "ledgerClosed":
+                    self._ledger_closed(message["ledger_index"])
+                elif message.get("type") == "transaction" and message.get("validated"):
+                    # api v2 puts the hash at the top level, v1 inside `transaction`
+                    tx_hash = message["hash"] if "hash" in message else message["transaction"]["hash"]
+                    if tx_hash in self.pending:
+                        self._resolve(tx_hash, {
+                            "result": message["meta"]["TransactionResult"],
+                            "validated": True,
+                            "ledger_index": message["ledger_index"],
+                            "meta": message["meta"],
+                        })
+        finally:
+            self._fail_pending("connection closed")
+
+    async def submit(self, signed: dict) -> asyncio.Future:
+        """submit a transaction signed with `sign_transaction`, returns a future of its outcome"""
+        if signed["account"] not in self._accounts:
+            self._accounts.add(signed["account"])
+            await self.client.request(Subscribe(accounts=[signed["account"]]))
+        future = asyncio.get_running_loop().create_future()
+        outcome = {"hash": signed["hash"], "engine_result": "", "result": "", "validated": False, "ledger_index": None, "meta": None}
+        # registered before submitting so a fast validation can't be missed
+        self.pending[signed["hash"]] = {"future": future, "outcome": outcome}
+        if signed["last_ledger_sequence"] is not None:
+            heapq.heappush(self._expiry, (signed["last_ledger_sequence"], signed["hash"]))
+        response = await self.client.request(SubmitOnly(tx_blob=signed["tx_blob"]))
+        result = response.result
+        outcome["engine_result"] = result.get("engine_result", result.get("error", ""))
+        if not response.is_successful() or outcome["engine_result"].startswith(FINAL_FAILURE_PREFIXES):
+            self._resolve(signed["hash"], {"result": outcome["engine_result"]})
+        return future
+
+    async def submit_many(self, signed: List[dict]) -> List[dict]:
+        """submit signed transactions in order and wait for all of their outcomes"""
+        futures = [await self.submit(tx) for tx in signed]
+        return list(await asyncio.gather(*futures))
+
+
+# endregion
+
+
+# region JOURNAL
+"""append-only json lines record of bulk jobs so an interrupted run can resume where it stopped"""
+
+
+def load_journal(path: str) -> dict:
+    """return the last record written for every key in a journal, {} if there is none yet"""
+    records = {}
+    if path is None or not os.path.exists(path):
+        return records
+    with open(path) as journal:
+        for line in journal:
+            line = line.strip()
+            if line:
+                record = json.loads(line)
+                records[record["key"]] = record
+    return records
+
+
+def append_journal(path: str, records: List[dict]) -> None:
+    """write records, each with a `key`, and flush them to disk before returning"""
+    if path is None or not records:
+        return
+    with open(path, "a") as journal:
+        for record in records:
+            journal.write(json.dumps(record) + "\n")
+        journal.flush()
+        os.fsync(journal.fileno())
+
+
+def journal_pending(record: dict, signed: dict, ledger_index: int) -> dict:
+    """copy of a journal record marked pending with what is needed to look the transaction up later\n
+    `ledger_index` is a ledger from before the submit, the transaction can only be in ledgers from there to its LastLedgerSequence.
+    journal it before submitting so a crash mid batch can't lose a transaction that applied"""
+    return dict(
+        record,
+        hash=signed["hash"],
+        sequence=signed["sequence"],
+        min_ledger=ledger_index,
+        last_ledger_sequence=signed["last_ledger_sequence"],
+        result="pending",
+    )
+
+
+async def resolve_pending(url: str, records: Dict[str, dict], limit: int = 10, history_wait: int = 10) -> Dict[str, dict]:
+    """final outcome of journaled pending transactions, {key: {hash, result, validated, ledger_index, meta}}\n
+    each hash is looked up with `tx` over the ledgers it could be in; it comes back "expired" only once the validated ledger
+    is past its LastLedgerSequence and the node confirms it searched all of them, anything else is waited on a ledger at a time.
+    raises RuntimeError if the node still lacks part of that history `history_wait` ledgers later, ask a full history node then"""
+    client = AsyncJsonRpcClient(url)
+    semaphore = asyncio.Semaphore(limit)
+    waiting = dict(records)
+    outcomes = {}
+
+    async def lookup(record: dict) -> dict:
+        last = record["last_ledger_sequence"]
+        # rippled searches at most 1000 ledgers per request
+        first = max(record.get("min_ledger") or 1, last - MAX_TX_LEDGER_RANGE, 1)
+        async with semaphore:
+            return (await client.request(Tx(transaction=record["hash"], min_ledger=first, max_ledger=last))).result
+
+    while waiting:
+        # read the ledger first so a transaction missing from `tx` is missing from it too
+        validated = (await client.request(Ledger(ledger_index="validated"))).result["ledger_index"]
+        keys = list(waiting)
+        results = await asyncio.gather(*(lookup(waiting[key]) for key in keys))
+        for key, result in zip(keys, results):
+            record = waiting[key]
+            if result.get("validated"):
+                outcomes[key] = {"hash": record["hash"], "result": result["meta"]["TransactionResult"], "validated": True, "ledger_index": result["ledger_index"], "meta": result["meta"]}
+            elif validated > record["last_ledger_sequence"] and result.get("error") == "txnNotFound" and result.get("searched_all"):
+                outcomes[key] = {"hash": record["hash"], "result": "expired", "validated": False, "ledger_index": validated, "meta": None}
+            elif validated > record["last_ledger_sequence"] + history_wait:
+                raise RuntimeError(f"can't settle {record['hash']}: the node is missing ledgers up to {record['last_ledger_sequence']} ({result.get('error', 'not validated')})")
+            else:
+                continue
+            del waiting[key]
+        if waiting:
+            await asyncio.sleep(LEDGER_SECONDS)
+    return outcomes
+
+
+# endregion
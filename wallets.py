@@ -1,3 +1,4 @@
+import asyncio
 from xrpl.models import (
     NFTokenAcceptOffer,
     NFTokenCreateOffer,
@@ -24,10 +25,21 @@ from misc import (
 )
 from x_constants import M_SOURCE_TAG, PAYMENT_FLAGS
 from xrpl.wallet import Wallet
-from decimal import Decimal
-from typing import Union
-
-from xrpl.asyncio.clients import AsyncJsonRpcClient
+from decimal import ROUND_CEILING, Decimal
+import json
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator, Iterator, Union
+
+from Crypto.Cipher import AES
+from xrpl import CryptoAlgorithm
+from xrpl.core.addresscodec import decode_seed
+from xrpl.core.keypairs import derive_classic_address, generate_seed
+from xrpl.core.keypairs.ed25519 import ED25519
+from xrpl.core.keypairs.secp256k1 import SECP256K1
+
+from xrpl.asyncio.clients import AsyncJsonRpcClient, AsyncWebsocketClient
 from xrpl.clients import JsonRpcClient
 from xrpl.asyncio.ledger import get_fee
 from xrpl.models import (
@@ -40,13 +52,22 @@ from xrpl.models import (
     NFTokenAcceptOffer,
     NFTokenCreateOffer,
     NFTokenCreateOfferFlag,
+    PathFind,
+    PathFindSubcommand,
+    PathStep,
     Payment,
     PaymentFlag,
+    RipplePathFind,
+    ServerInfo,
+    StreamParameter,
+    Subscribe,
     Tx,
 )
 from xrpl.utils import drops_to_xrp, ripple_time_to_datetime, xrp_to_drops
 
 from misc import (
+    LedgerCache,
+    gather_limited,
     is_hex,
     memo_builder,
     validate_hex_to_symbol,
@@ -56,6 +77,12 @@ from misc import (
 
 from x_constants import D_DATA, D_TYPE, M_SOURCE_TAG
 
+# path finding results, keyed by (url, sender, receiver, token, issuer, amount bucket)
+PAYMENT_PATHS = LedgerCache()
+
+# base and owner reserve in drops, keyed by url; reserves only move on flag ledger votes
+NETWORK_RESERVES = LedgerCache()
+RESERVES_MAX_AGE = 900
 
 # https://xrpl.org/docs/references/protocol/transactions/types/payment#example-payment-json
 
@@ -78,7 +105,7 @@ def send_xrp(
         destination_tag=destination_tag,
         source_tag=M_SOURCE_TAG,
         fee=fee,
-        memos=[memo_builder(memo_data=note)],
+        memos=[memo_builder(memo_data=note)] if note else mm(),
     )
     return txn.to_xrpl()
 
@@ -95,14 +122,21 @@ def send_token(
     destination_tag: int = None,
     note: str = None,
     fee: str = None,
+    send_max: Union[str, dict, IssuedCurrencyAmount] = None,
+    paths: list = None,
 ) -> dict:
     """send asset...
     if token has fee - enable partial
-    max amount = 15 decimal places"""
+    max amount = 15 decimal places\n
+    for cross-currency payments pass `send_max` and `paths` of an alternative from `find_payment_paths`"""
     cur = token if is_lp_token else validate_symbol_to_hex(token)
     flags = 0
     if partial:
         flags = PaymentFlag.TF_PARTIAL_PAYMENT.value
+    if send_max is None:
+        send_max = IssuedCurrencyAmount(currency=cur, issuer=issuer, value=amount)
+    elif isinstance(send_max, dict):
+        send_max = IssuedCurrencyAmount.from_dict(send_max)
     txn = Payment(
         account=sender_addr,
         destination=receiver_addr,
@@ -110,8 +144,9 @@ def send_token(
         destination_tag=destination_tag,
         fee=fee,
         flags=flags,
-        send_max=IssuedCurrencyAmount(currency=cur, issuer=issuer, value=amount),
-        memos=[memo_builder(memo_data=note)],
+        send_max=send_max,
+        paths=[[PathStep.from_dict(step) for step in path] for path in paths] if paths else None,
+        memos=[memo_builder(memo_data=note)] if note else mm(),
         source_tag=M_SOURCE_TAG,
     )
     return txn.to_xrpl()
@@ -127,7 +162,7 @@ def send_nft(
         amount="0",
         destination=receiver,
         flags=NFTokenCreateOfferFlag.TF_SELL_NFTOKEN.value,
-        memos=[memo_builder(memo_data=note)],
+        memos=[memo_builder(memo_data=note)] if note else mm(),
         source_tag=M_SOURCE_TAG,
         fee=fee,
     )
@@ -188,23 +223,79 @@ def parse_pay_txn_flag(pay_flag: int) -> list:
 
 async def get_network_fee(url: str) -> str:
     """return transaction fee, to populate interface and carry out transactions"""
-    return await get_fee(await AsyncJsonRpcClient(url))
+    return await get_fee(AsyncJsonRpcClient(url))
+
+
+def set_network_reserves(url: str, base: int, owner: int, ledger_index: int) -> dict:
+    """cache a network's reserves in drops, e.g from a ledger stream message"""
+    reserves = {"base": int(base), "owner": int(owner), "ledger_index": ledger_index}
+    NETWORK_RESERVES.set(url, ledger_index, reserves)
+    return reserves
+
+
+async def network_reserves(url: str, max_age: float = RESERVES_MAX_AGE) -> dict:
+    """return the base and per object owner reserve in drops, read from server_info at most every `max_age` seconds"""
+    cached = NETWORK_RESERVES.get(url, max_age=max_age)
+    if cached is not None:
+        return cached
+    response = await AsyncJsonRpcClient(url).request(ServerInfo())
+    result = response.result
+    if "info" not in result or "validated_ledger" not in result["info"]:
+        raise ValueError(f"no validated ledger to read reserves from: {result.get('error', '')}")
+    ledger = result["info"]["validated_ledger"]
+    return set_network_reserves(url, xrp_to_drops(ledger["reserve_base_xrp"]), xrp_to_drops(ledger["reserve_inc_xrp"]), ledger["seq"])
+
+
+async def watch_network_reserves(ws_url: str, url: str = None) -> None:
+    """keep the reserves of `url` (default `ws_url`) current from the ledger stream, runs until cancelled\n
+    every ledgerClosed message carries the reserves so a fee vote is picked up on the ledger it applies"""
+    async with AsyncWebsocketClient(ws_url) as client:
+        response = await client.request(Subscribe(streams=[StreamParameter.LEDGER]))
+        result = response.result
+        if "reserve_base" in result:
+            set_network_reserves(url or ws_url, result["reserve_base"], result["reserve_inc"], result["ledger_index"])
+        async for message in client:
+            if message.get("type") == "ledgerClosed":
+                set_network_reserves(url or ws_url, message["reserve_base"], message["reserve_inc"], message["ledger_index"])
+
+
+def spendable_xrp(account_data: dict, reserves: dict) -> dict:
+    """balance above the reserve of an account_info `account_data`, in xrp"""
+    owner_count = int(account_data["OwnerCount"])
+    reserve = reserves["base"] + reserves["owner"] * owner_count
+    balance = max(int(account_data["Balance"]) - reserve, 0)
+    return {"object_count": owner_count, "balance": str(drops_to_xrp(str(balance))), "reserve": str(drops_to_xrp(str(reserve)))}
 
 
-# TODO: will have to update to match the new xrpl reserve
 async def xrp_balance(url: str, wallet_addr: str) -> dict:
     """return xrp balance and objects count"""
-    _balance = 0
-    owner_count = 0
-    balance = 0
     acc_info = AccountInfo(account=wallet_addr, ledger_index="validated")
-    response = await AsyncJsonRpcClient(url).request(acc_info)
+    response, reserves = await asyncio.gather(AsyncJsonRpcClient(url).request(acc_info), network_reserves(url))
     result = response.result
     if "account_data" in result:
-        _balance = int(result["account_data"]["Balance"]) - 10000000
-        owner_count = int(result["account_data"]["OwnerCount"])
-        balance = _balance - (2000000 * owner_count)
-    return {"object_count": owner_count, "balance": str(drops_to_xrp(str(balance)))}
+        return spendable_xrp(result["account_data"], reserves)
+    return {"object_count": 0, "balance": "0", "reserve": "0"}
+
+
+async def xrp_balances(url: str, wallet_addrs: list, limit: int = 10) -> dict:
+    """return `xrp_balance` for many accounts, {address: balance}, all read from the same validated ledger\n
+    reserves come from the cache so there is one account_info call per account and nothing else"""
+    if not wallet_addrs:
+        return {}
+    reserves = await network_reserves(url)
+    client = AsyncJsonRpcClient(url)
+    first = await client.request(AccountInfo(account=wallet_addrs[0], ledger_index="validated"))
+    # pin the rest to the ledger of the first so balances are consistent with each other
+    ledger_index = first.result.get("ledger_index", "validated")
+    responses = [first] + await gather_limited((client.request(AccountInfo(account=addr, ledger_index=ledger_index)) for addr in wallet_addrs[1:]), limit)
+    balances = {}
+    for addr, response in zip(wallet_addrs, responses):
+        result = response.result
+        if "account_data" in result:
+            balances[addr] = spendable_xrp(result["account_data"], reserves)
+        else:
+            balances[addr] = {"object_count": 0, "balance": "0", "reserve": "0"}
+    return balances
 
 
 async def xrp_transactions(url: str, wallet_addr: str) -> dict:
@@ -416,4 +507,224 @@ async def payment_transaction_info(url: str, txid: str) -> dict:
     return pay_dict
 
 
+def amount_bucket(amount: Decimal, digits: int = 2) -> Decimal:
+    """round an amount up to `digits` significant digits, e.g 123.4 -> 130"""
+    if amount <= 0:
+        return amount
+    step = Decimal(1).scaleb(amount.adjusted() - digits + 1)
+    return (amount / step).to_integral_value(rounding=ROUND_CEILING) * step
+
+
+def path_destination_amount(token: str, amount: Decimal, issuer: str = "") -> Union[str, IssuedCurrencyAmount]:
+    if token == "XRP":
+        return xrp_to_drops(amount)
+    return IssuedCurrencyAmount(currency=validate_symbol_to_hex(token), issuer=issuer, value=format(amount, "f"))
+
+
+def parse_path_alternative(alternative: dict, scale: Decimal = Decimal(1)) -> dict:
+    """parse a path finding alternative, `send_max` and `paths` can be passed straight to `send_token`\n
+    the source amount is multiplied by `scale` when the search was run for a bucketed amount"""
+    path = {}
+    source = alternative["source_amount"]
+    if isinstance(source, str):
+        drops = int((Decimal(source) * scale).to_integral_value(rounding=ROUND_CEILING))
+        path["token"] = "XRP"
+        path["issuer"] = ""
+        path["amount"] = str(drops_to_xrp(str(drops)))
+        path["send_max"] = str(drops)
+    else:
+        value = str((Decimal(source["value"]) * scale).normalize())
+        path["token"] = validate_hex_to_symbol(source["currency"])
+        path["issuer"] = source["issuer"]
+        path["amount"] = value
+        path["send_max"] = {"currency": source["currency"], "issuer": source["issuer"], "value": value}
+    path["paths"] = alternative["paths_computed"] if "paths_computed" in alternative else []
+    return path
+
+
+async def find_payment_paths(
+    url: str,
+    sender_addr: str,
+    receiver_addr: str,
+    token: str,
+    amount: Union[str, float, Decimal],
+    issuer: str = "",
+    ledger_index: int = None,
+    max_age: float = 10,
+    bucket_digits: int = 2,
+) -> list:
+    """return the ways `sender_addr` can deliver `amount` of `token` to `receiver_addr`, cheapest source first\n
+    the search runs for the amount rounded up to `bucket_digits` significant digits so nearby amounts share one ripple_path_find;
+    source amounts are scaled back to `amount`\n
+    results are cached per ledger: with `ledger_index` only a search at that ledger is reused, without it one younger than `max_age` seconds"""
+    amount = Decimal(str(amount))
+    bucket = amount_bucket(amount, bucket_digits)
+    key = (url, sender_addr, receiver_addr, token, issuer, bucket)
+    alternatives = PAYMENT_PATHS.get(key, ledger_index, max_age if ledger_index is None else None)
+    if alternatives is None:
+        req = RipplePathFind(
+            source_account=sender_addr,
+            destination_account=receiver_addr,
+            destination_amount=path_destination_amount(token, bucket, issuer),
+            ledger_index="validated" if ledger_index is None else ledger_index,
+        )
+        response = await AsyncJsonRpcClient(url).request(req)
+        result = response.result
+        alternatives = result["alternatives"] if "alternatives" in result else []
+        if "ledger_index" in result:
+            PAYMENT_PATHS.set(key, result["ledger_index"], alternatives)
+    scale = amount / bucket if bucket else Decimal(1)
+    paths = [parse_path_alternative(alternative, scale) for alternative in alternatives]
+    paths.sort(key=lambda path: (path["token"], Decimal(path["amount"])))
+    return paths
+
+
+async def stream_payment_paths(
+    ws_url: str,
+    sender_addr: str,
+    receiver_addr: str,
+    token: str,
+    amount: Union[str, float, Decimal],
+    issuer: str = "",
+) -> AsyncIterator[list]:
+    """yield live path alternatives from a path_find subscription, a new list each time the server updates them\n
+    closing the generator closes the websocket, which also ends the subscription on the server"""
+    async with AsyncWebsocketClient(ws_url) as client:
+        req = PathFind(
+            subcommand=PathFindSubcommand.CREATE,
+            source_account=sender_addr,
+            destination_account=receiver_addr,
+            destination_amount=path_destination_amount(token, Decimal(str(amount)), issuer),
+        )
+        response = await client.request(req)
+        if "alternatives" in response.result:
+            yield [parse_path_alternative(alternative) for alternative in response.result["alternatives"]]
+        async for message in client:
+            if message.get("type") == "path_find" and "alternatives" in message:
+                yield [parse_path_alternative(alternative) for alternative in message["alternatives"]]
+
+
+# endregion
+
+
+# region GENERATE
+"""bulk custodial wallet creation, keys are generated in worker processes and only ever written encrypted"""
+
+# file magic of an encrypted wallet file, followed by AES-GCM frames of json lines and a final frame with the counts
+WALLET_FILE_MAGIC = b"MYRKLEW1"
+# appended to the associated data of the final frame so it can't pass for a wallet frame or the other way round
+WALLET_FILE_END = b"END"
+
+
+def generate_wallet_batch(count: int, algorithm: str = "ed25519") -> list:
+    """create `count` wallets, a list of {address, public_key, seed, algorithm}\n
+    keys come straight from the curve module; `derive_keypair` also signs and verifies a test message per key,
+    which takes most of its time and checks nothing a bulk run needs"""
+    algorithm = CryptoAlgorithm(algorithm)
+    curve = ED25519 if algorithm == CryptoAlgorithm.ED25519 else SECP256K1
+    wallets = []
+    for _ in range(count):
+        seed = generate_seed(algorithm=algorithm)
+        public_key, _ = curve.derive_keypair(decode_seed(seed)[0], False)
+        wallets.append({"address": derive_classic_address(public_key), "public_key": public_key, "seed": seed, "algorithm": algorithm.value})
+    return wallets
+
+
+class EncryptedWalletSink:
+    """append wallets to a file as AES-GCM encrypted frames, one frame per `write`\n
+    every frame has its own nonce and authenticates its position, so frames can't be dropped or reordered unnoticed;
+    `close` adds an authenticated final frame with the frame and wallet counts, so a truncated file doesn't read back cleanly.
+    `key` is 16, 24 or 32 random bytes kept outside the file; read back with `read_encrypted_wallets`"""
+
+    def __init__(self, path: str, key: bytes):
+        if len(key) not in (16, 24, 32):
+            raise ValueError("key must be 16, 24 or 32 bytes")
+        self.key = key
+        self.frames = 0
+        self.count = 0
+        self.file = open(path, "xb")  # never overwrite existing keys
+        self.file.write(WALLET_FILE_MAGIC)
+
+    def _write_frame(self, plaintext: bytes, associated_data: bytes) -> None:
+        cipher = AES.new(self.key, AES.MODE_GCM)
+        cipher.update(associated_data)
+        ciphertext, tag = cipher.encrypt_and_digest(plaintext)
+        self.file.write(struct.pack(">I", len(ciphertext)) + cipher.nonce + tag + ciphertext)
+
+    def write(self, wallets: list) -> None:
+        if not wallets:
+            return
+        plaintext = "".join(json.dumps(wallet) + "\n" for wallet in wallets).encode()
+        self._write_frame(plaintext, struct.pack(">Q", self.frames))
+        self.frames += 1
+        self.count += len(wallets)
+
+    def close(self) -> None:
+        self._write_frame(struct.pack(">QQ", self.frames, self.count), struct.pack(">Q", self.frames) + WALLET_FILE_END)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def read_encrypted_wallets(path: str, key: bytes) -> Iterator[dict]:
+    """yield the wallets of a file written by `EncryptedWalletSink`, raises ValueError if it was tampered with or truncated\n
+    wallets are yielded frame by frame, a missing final frame is only noticed after the wallets before it were yielded"""
+    with open(path, "rb") as file:
+        if file.read(len(WALLET_FILE_MAGIC)) != WALLET_FILE_MAGIC:
+            raise ValueError(f"{path} is not an encrypted wallet file")
+        frame = 0
+        count = 0
+        while True:
+            header = file.read(4)
+            if len(header) < 4:
+                raise ValueError(f"{path} is truncated, its final frame is missing")
+            size = struct.unpack(">I", header)[0]
+            nonce, tag, ciphertext = file.read(16), file.read(16), file.read(size)
+            if len(nonce) < 16 or len(tag) < 16 or len(ciphertext) < size:
+                raise ValueError(f"{path} is truncated in frame {frame}")
+            final = not file.peek(1)
+            cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+            cipher.update(struct.pack(">Q", frame) + (WALLET_FILE_END if final else b""))
+            try:
+                plaintext = cipher.decrypt_and_verify(ciphertext, tag)
+            except ValueError:
+                raise ValueError(f"{path} frame {frame} failed authentication, the file was tampered with or truncated") from None
+            if final:
+                if struct.unpack(">QQ", plaintext) != (frame, count):
+                    raise ValueError(f"{path} final frame doesn't match its {frame} frames and {count} wallets")
+                return
+            for line in plaintext.decode().splitlines():
+                yield json.loads(line)
+                count += 1
+            frame += 1
+
+
+def generate_wallets(
+    count: int,
+    sink: EncryptedWalletSink,
+    algorithm: Union[str, CryptoAlgorithm] = "ed25519",
+    workers: int = None,
+    chunksize: int = 1000,
+) -> int:
+    """create `count` wallets across a process pool and stream them to `sink` in chunks as they finish\n
+    secp256k1 key derivation is several times slower than ed25519, size the run accordingly.
+    returns how many wallets were written"""
+    algorithm = CryptoAlgorithm(algorithm).value
+    chunks = [min(chunksize, count - start) for start in range(0, count, chunksize)]
+    if len(chunks) <= 1:
+        for chunk in chunks:
+            sink.write(generate_wallet_batch(chunk, algorithm))
+        return count
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for wallets in pool.map(generate_wallet_batch, chunks, [algorithm] * len(chunks)):
+            sink.write(wallets)
+    return count
+
+
 # endregion
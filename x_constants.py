@@ -8,10 +8,14 @@ D_DATA = "https://myrkle.app"
 XURLS_ = {
     "TESTNET_URL": "https://s.altnet.rippletest.net:51234",
     "MAINNET_URL": "https://xrplcluster.com",
+    "TESTNET_WS": "wss://s.altnet.rippletest.net:51233",
+    "MAINNET_WS": "wss://xrplcluster.com",
     "TESTNET_TXNS": "https://testnet.xrpl.org/transactions/",
     "MAINNET_TXNS": "https://livenet.xrpl.org/transactions/",
     "MAINNET_ACCOUNT": "https://livenet.xrpl.org/accounts/",
     "TESTNET_ACCOUNT": "https://testnet.xrpl.org/accounts/",
+    "IPFS_GATEWAY": "https://ipfs.io/ipfs/",
+    "ARWEAVE_GATEWAY": "https://arweave.net/",
 }
 
 